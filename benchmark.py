@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import argparse
+import contextlib
+import csv
+import json
+import os
+import platform
+import sys
+import tempfile
+from random import Random
+from timeit import default_timer as timer
+
+import winestrings as wines
+import vegan_wine_search
+import generatehtml
+
+# The columns of Vinmonopolet's produkter.csv export
+csv_columns = ["Datotid", "Varenummer", "Varenavn", "Volum", "Pris", "Literpris", "Varetype", "Produktutvalg", "Butikkategori",
+               "Fylde", "Friskhet", "Garvestoffer", "Bitterhet", "Sodme", "Farge", "Lukt", "Smak", "Passertil01", "Passertil02",
+               "Passertil03", "Land", "Distrikt", "Underdistrikt", "Argang", "Rastoff", "Metode", "Alkohol", "Sukker", "Syre",
+               "Lagringsgrad", "Produsent", "Grossist", "Distributor", "Emballasjetype", "Korktype", "Vareurl", "Okologisk",
+               "Biodynamisk", "Fairtrade", "Miljosmart_emballasje", "Gluten_lav_pa", "Kosher", "HovedGTIN", "AndreGTINs"]
+
+syllables = ["ba", "co", "di", "el", "fa", "go", "li", "ma", "no", "ra", "si", "ta", "ve", "zu"]
+
+
+def name_variant(name, copy, random):
+    # copy 0 is the original name, the others get a made up word, so they stay similar to the original
+    if not copy:
+        return name
+    word = "".join(random.choice(syllables) for _ in range(3)).capitalize()
+    return "{} {}".format(name, word)
+
+
+def generate_dataset(directory, scale, seed=1):
+    """Writes produkter.csv and wine.json to directory, the bundled products and Barnivore companies repeated scale times under varied names"""
+    random = Random(seed)
+    products = {}
+    for filename in [vegan_wine_search.vegan_friendly_output_filename, vegan_wine_search.some_vegan_products_output_filename]:
+        with open(filename, encoding='utf-8') as f:
+            for company in json.load(f):
+                for product in company["products_found_at_vinmonopolet"]:
+                    products[product["Varenummer"]] = product
+
+    producer_names = {}
+    with open(os.path.join(directory, "produkter.csv"), mode='w', newline='', encoding='iso-8859-1', errors='replace') as f:
+        writer = csv.writer(f, delimiter=';')
+        writer.writerow(csv_columns)
+        for copy in range(scale):
+            for product in products.values():
+                row = {column: product.get(column, "") for column in csv_columns}
+                key = (row["Produsent"], copy)
+                if key not in producer_names:
+                    producer_names[key] = name_variant(row["Produsent"], copy, random)
+                row["Produsent"] = producer_names[key]
+                row["Varenummer"] = "{}{:03d}".format(row["Varenummer"], copy)
+                writer.writerow([row[column] for column in csv_columns])
+
+    with open("wine.json", encoding='utf-8') as f:
+        barnivore_companies = list(wines.iter_json_array(f))
+    with open(os.path.join(directory, "wine.json"), mode='w', encoding='utf-8') as f:
+        copies = []
+        for copy in range(scale):
+            for candidate in barnivore_companies:
+                company = dict(candidate["company"])
+                company["company_name"] = name_variant(company["company_name"], copy, random)
+                company["id"] = company["id"] + 100000 * copy
+                copies.append({"company": company})
+        json.dump(copies, f)
+
+
+def time_stage(results, stage, function, *args):
+    start = timer()
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        value = function(*args)
+    results[stage] = min(results.get(stage, float("inf")), timer() - start)
+    return value
+
+
+def render_html(directory):
+    generatehtml.write_html(os.path.join(directory, "viner.html"),
+                            [os.path.join(directory, x) for x in generatehtml.result_filenames])
+
+
+def run_benchmark(directory, repeat=1):
+    """Runs each stage of the pipeline on the dataset in directory, returns the best time of each stage in seconds"""
+    csv_filename = os.path.join(directory, "produkter.csv")
+    barnivore_filename = os.path.join(directory, "wine.json")
+    stages = {}
+    counts = {}
+    for _ in range(repeat):
+        wines.default_normalizer.cache_clear()
+        wines.classify_varetype.cache_clear()
+        wines.prepare_for_ratio.cache_clear()
+        companies_at_vinmonopolet = time_stage(stages, "csv_import", wines.load_companies_from_vinmonopolet, csv_filename, ["wine"])["wine"]
+        companies_from_barnivore = time_stage(stages, "barnivore_load", wines.load_companies_from_barnivore, barnivore_filename)
+        stopwords = time_stage(stages, "create_stopword_list", wines.create_stopword_list, companies_from_barnivore, companies_at_vinmonopolet)
+        time_stage(stages, "add_normalized_names", lambda: (wines.add_normalized_names(companies_at_vinmonopolet, stopwords),
+                                                            wines.add_normalized_names(companies_from_barnivore, stopwords)))
+        matches = time_stage(stages, "find_possible_company_matches", vegan_wine_search.find_possible_company_matches,
+                             companies_from_barnivore, companies_at_vinmonopolet, None, False)
+        time_stage(stages, "write_result_file", vegan_wine_search.write_result_file, matches,
+                   os.path.join(directory, vegan_wine_search.vegan_friendly_output_filename),
+                   os.path.join(directory, vegan_wine_search.some_vegan_products_output_filename))
+        time_stage(stages, "generatehtml", render_html, directory)
+        counts = {"vinmonopolet_companies": len(companies_at_vinmonopolet),
+                  "barnivore_companies": len(companies_from_barnivore),
+                  "matches": len([x for x in matches if x.get("products_found_at_vinmonopolet")])}
+    return stages, counts
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time each stage of the pipeline on generated datasets, and print the result as JSON")
+    parser.add_argument("--scales", default="1,10", help="comma separated list of how many times to repeat the bundled data (default: %(default)s)")
+    parser.add_argument("--repeat", type=int, default=1, help="runs per scale, the best time of each stage is reported")
+    parser.add_argument("--output", help="write the JSON to this file instead of stdout")
+    args = parser.parse_args()
+
+    report = {"python": platform.python_version(), "machine": platform.machine(), "cpu_count": os.cpu_count(), "runs": []}
+    for scale in [int(x) for x in args.scales.split(",")]:
+        with tempfile.TemporaryDirectory() as directory:
+            print("Generating dataset, scale {}".format(scale), file=sys.stderr)
+            generate_dataset(directory, scale)
+            stages, counts = run_benchmark(directory, args.repeat)
+            report["runs"].append({"scale": scale, "counts": counts, "seconds": stages})
+            print(json.dumps(report["runs"][-1]), file=sys.stderr)
+
+    if args.output:
+        with open(args.output, mode='w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
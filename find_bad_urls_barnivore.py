@@ -1,56 +1,43 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
-import multiprocessing
+import argparse
+import json
 import logging
-from logging.handlers import QueueHandler, QueueListener
 
 import winestrings as wines
 import http_helper
-import requests
 
 
-# multiprocessor logging courtesy of https://stackoverflow.com/a/34964369/788913
+def check_company_sites(companies, max_concurrent, max_connections_per_host):
+    records = http_helper.check_urls([c["url"] for c in companies], max_concurrent, max_connections_per_host,
+                                     identifiers=[c["id"] for c in companies],
+                                     names=[c["company_name"] for c in companies])
+    for company, record in zip(companies, records):
+        if record.error:
+            logging.error("Website retrieval error;{};{};{};{};{}".format(company["red_yellow_green"],
+                                                                         company["company_name"],
+                                                                         company["id"],
+                                                                         record.error,
+                                                                         record.status))
+    return records
 
-def worker_init(q):
-    # all records from worker processes go to qh and then into q
-    qh = QueueHandler(q)
-    logger = logging.getLogger()
-    logger.setLevel(logging.INFO)
-    logger.addHandler(qh)
 
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Find companies in Barnivore with missing or broken website urls")
+    parser.add_argument("--concurrency", type=int, default=64, help="max number of requests in flight")
+    parser.add_argument("--per-host", type=int, default=4, help="max number of connections to each host")
+    parser.add_argument("--records", help="write one JSON record per checked url to this file")
+    parser.add_argument("--http-cache", metavar="DIR",
+                        help="cache fetched web pages in this directory, revalidating them after --http-cache-ttl seconds")
+    parser.add_argument("--http-cache-ttl", type=int, default=24 * 3600)
+    args = parser.parse_args()
 
-def logger_init():
-    q = multiprocessing.Queue()
-    # this is the handler for all log records
-    handler = logging.StreamHandler()
-    handler.setFormatter(logging.Formatter("%(levelname)s: %(asctime)s - %(process)s - %(message)s"))
-
-    # ql gets records from the queue and sends them to the handler
-    ql = QueueListener(q, handler)
-    ql.start()
-
-    logger = logging.getLogger()
-    logger.setLevel(logging.INFO)
-    # add the handler to the logger so records from this process are handled
-    logger.addHandler(handler)
-
-    return ql, q
-
-
-def visit_company_site(company):
-    try:
-        logging.debug("fetching {}".format(company["url"]))
-        http_helper.get_webpage(company["url"], company["id"], company["company_name"])
-    except requests.exceptions.RequestException as ex:
-        logging.error("Website retrieval error;{};{};{};{}".format(company["red_yellow_green"],
-                                                                   company["company_name"],
-                                                                   company["id"],
-                                                                   str(ex)))
-
+    if args.http_cache:
+        http_helper.enable_cache(args.http_cache, ttl=args.http_cache_ttl)
 
-if __name__ == "__main__":
-    q_listener, q = logger_init()
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s: %(asctime)s - %(message)s")
 
+    records_file = open(args.records, mode='w', encoding='utf-8') if args.records else None
     for source in ["wine.json", "beer.json", "liquor.json"]:
         logging.info("*********")
         logging.info(source)
@@ -65,7 +52,14 @@ if __name__ == "__main__":
                                                               company["company_name"],
                                                               company["id"]))
 
-        num_agents = 4 * (multiprocessing.cpu_count() - 1 or 1)  # Let's us many processes for the IO-heavy work
-        chunk_size = min(50, len(got_url))
-        with multiprocessing.Pool(num_agents, worker_init, [q]) as pool:
-            result = pool.map(visit_company_site, got_url, chunk_size)
+        records = check_company_sites(got_url, args.concurrency, args.per_host)
+        failed = [x for x in records if x.error]
+        logging.info("Checked {} urls, {} failed".format(len(records), len(failed)))
+
+        if records_file:
+            for company, record in zip(got_url, records):
+                json.dump(dict(record._asdict(), source=source, id=company["id"]), records_file, ensure_ascii=False)
+                records_file.write("\n")
+
+    if records_file:
+        records_file.close()
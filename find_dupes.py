@@ -1,129 +1,157 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-from fuzzywuzzy import fuzz
-import multiprocessing
+from collections import Counter, defaultdict
+import numpy as np
 import winestrings as wines
 
 
-def sort_by_ratio(item):
-    return item[0]
+def min_shared_grams(length, other_length, min_ratio, n):
+    # a ratio above min_ratio leaves few characters unmatched, and each of them breaks at most n of the n-grams
+    unmatched = (length + other_length) * (100 - min_ratio) // 100
+    return length - n + 1 - n * unmatched
 
 
-def import_products_from_vinmonopolet(companies_at_vinmonopolet):
-    company_names = set()
-    company_id_map = {}
-    for item in companies_at_vinmonopolet:
-        name = item["company_name"]
-        company_names.add(name)
-        company_id_map[name] = item["id"]
-
-    return (company_names, company_id_map)
+def find_duplicate_candidates(companies, min_ratio):
+    """Yields (name, [names that may be duplicates of it]) for names sharing enough 3-grams for a ratio above min_ratio, each pair once"""
+    prepared = [wines.prepare_for_ratio(x) for x in companies]
+    index = wines.NgramIndex(prepared, n=3, key=None)
+    n = index.n
+    postings = {gram: np.array(positions) for gram, positions in index.postings.items()}
+    lengths = np.array([len(x) for x in prepared])
+    short_names = [i for i, name in enumerate(prepared) if len(name) < n]
+    for i, name in enumerate(prepared):
+        if len(name) < n:
+            candidates = np.array([j for j in short_names if j < i], dtype=int)
+        else:
+            # names are sorted, so the names before this one are the ones it is compared with
+            counts = Counter(name[k:k + n] for k in range(len(name) - n + 1))
+            grams = sorted(counts, key=lambda x: (len(postings[x]), x))
+            # a name sharing none of the rarest grams shares too few, even the longest the length check lets through
+            required = max(1, min_shared_grams(len(name), len(name) * (200 - min_ratio) // min_ratio, min_ratio, n))
+            prefix_length = len(name) - n + 1 - required + 1
+            prefix = []
+            for gram in grams:
+                if prefix_length <= 0:
+                    break
+                prefix.append(postings[gram][:np.searchsorted(postings[gram], i)])
+                prefix_length -= counts[gram]
+            candidates = np.unique(np.concatenate(prefix))
+
+        # the ratio can at most be 2 * shortest length / total length
+        other_lengths = lengths[candidates]
+        candidates = candidates[200 * np.minimum(len(name), other_lengths) > min_ratio * (len(name) + other_lengths)]
+        if len(name) >= n and len(candidates):
+            shared = np.zeros(len(candidates), dtype=int)
+            for gram in grams:
+                positions = postings[gram]
+                found = positions[np.minimum(np.searchsorted(positions, candidates), len(positions) - 1)] == candidates
+                shared += counts[gram] * found
+            candidates = candidates[shared >= min_shared_grams(len(name), lengths[candidates], min_ratio, n)]
+        if len(candidates):
+            yield companies[i], [companies[j] for j in candidates]
+
+
+def find_duplicates(companies, ids_by_name, min_ratio=90):
+    """Returns (name, id, other name, other id, ratio) for similar names, with ids_by_name listing the ids of each name"""
+    companies = sorted(set(companies))
+    candidate_lists = list(find_duplicate_candidates(companies, min_ratio))
+    print("Comparing company names ({} of {} combinations)..".format(sum(len(x[1]) for x in candidate_lists),
+                                                                      len(companies) * (len(companies) - 1) // 2))
 
+    duplicates = []
+    for company in companies:
+        # companies with the same normalized name
+        ids = ids_by_name[company]
+        for i, id in enumerate(ids):
+            for other_company_id in ids[i + 1:]:
+                duplicates.append((company, id, company, other_company_id, 100))
+
+    for company, other_companies in candidate_lists:
+        # pairs are scored as (lowest name, highest name), like before
+        ratios = wines.ratio_matrix(other_companies, [company], min_ratio=min_ratio + 1)[:, 0]
+        for other_company, ratio in zip(other_companies, ratios):
+            if ratio > min_ratio:
+                for id in ids_by_name[other_company]:
+                    for other_company_id in ids_by_name[company]:
+                        duplicates.append((other_company, id, company, other_company_id, int(ratio)))
+
+    print("Similar company names:")
+    duplicates.sort(key=lambda x: x[4], reverse=True)
+    return duplicates
 
-def compute_similarity(company_tuple):
-    company, other_company = company_tuple
-    ratio = fuzz.token_sort_ratio(company, other_company)
-    return (ratio, company, other_company)
 
+def cluster_duplicates(duplicates):
+    """Groups the ids in duplicate pairs into clusters of companies that are all (transitively) similar, with union-find"""
+    parents = {}
 
-def find_duplicates(companies, id_map):
-    dataset = set()
-    for company in companies:
-        for other_company in companies:
-            if other_company == company:
-                continue
-            sorted_companies = sorted([company, other_company])
-            company_tuple = (sorted_companies[0], sorted_companies[1])
-            dataset.add(company_tuple)
+    def find(x):
+        parents.setdefault(x, x)
+        while parents[x] != x:
+            parents[x] = parents[parents[x]]
+            x = parents[x]
+        return x
 
-    print("Comparing company names ({} combinations)..".format(len(dataset)))
+    for (_, id, _, other_company_id, _) in duplicates:
+        root, other_root = find(id), find(other_company_id)
+        if root != other_root:
+            parents[other_root] = root
 
-    duplicates = []
-    num_agents = multiprocessing.cpu_count() - 1 or 1
-    chunk_size = int(len(dataset) / num_agents + 0.5)
-    with multiprocessing.Pool(processes=num_agents) as pool:
-        result = pool.map(compute_similarity, dataset, chunk_size)
-
-        print("Sorting matches by similarity...")
-        result.sort(key=sort_by_ratio, reverse=True)
-        print("Similar company names:")
-        for company in result:
-            (ratio, company, other_company) = company
-            if ratio > 90:
-                id = id_map[company]
-                other_company_id = id_map[other_company]
-                duplicate_tuple = (company, id, other_company, other_company_id, ratio)
-                duplicates.append(duplicate_tuple)
-            else:
-                break
-    return duplicates
+    clusters = defaultdict(list)
+    for id in parents:
+        clusters[find(id)].append(id)
+    return sorted(clusters.values(), key=len, reverse=True)
 
 
-def import_products_from_barnivore(companies):
-    company_names = set()
-    company_id_map = {}
-    for item in companies:
-        name = item["company_name"]
-        if not name in company_names:
-            company_names.add(name)
-            company_id_map[name] = item["id"]
-        else:
-            print("Identical company name: {}".format(name))
-            print("    http://www.barnivore.com/wine/{}/company".format(item["id"]))
-            print("    http://www.barnivore.com/wine/{}/company".format(company_id_map[name]))
+class CompanyIndex:
+    """Lookups by company id, normalized name and producer, built once for the whole duplicate report"""
 
-    return (company_names, company_id_map)
+    def __init__(self, companies):
+        self.companies_by_id = {}
+        self.ids_by_name = defaultdict(list)
+        self.product_ids_by_id = {}
+        for company in companies:
+            self.companies_by_id[company["id"]] = company
+            self.ids_by_name[wines.default_normalizer.abbreviated(company["company_name"])].append(company["id"])
+            self.product_ids_by_id[company["id"]] = [x["Varenummer"] for x in company.get("products_found_at_vinmonopolet", [])]
 
+    def company_name(self, id):
+        company = self.companies_by_id.get(id)
+        return company["company_name"] if company else None
 
-def find_product_ids_by_company_id(id, companies):
-    product_ids = []
-    for company in companies:
-        if company["id"] == id:
-            for product in company["products_found_at_vinmonopolet"]:
-                product_ids.append(product["Varenummer"])
-    return product_ids
+    def product_ids(self, id):
+        return self.product_ids_by_id.get(id, [])
 
 
-def find_company_name_by_id(id, companies):
-    for company in companies:
-        if company["id"] == id:
-            return company["company_name"]
-    return None
+def print_clusters(clusters, index):
+    print("{} clusters of similar company names:".format(len(clusters)))
+    for cluster in clusters:
+        print("    {}".format(", ".join("{} ({})".format(index.company_name(id), id) for id in cluster)))
 
 
 if __name__ == "__main__":
-    companies_from_barnivore = wines.load_companies_from_barnivore("liquor.json")
-    barnivore_companies, barnivore_id_map = import_products_from_barnivore(companies_from_barnivore)
-    barnivore_companies_normalized = [wines.normalize_name(wines.replace_abbreviations(x)) for x in barnivore_companies]
-    barnivore_id_map_normalized = {}
-    for key, value in barnivore_id_map.items():
-        barnivore_id_map_normalized[wines.normalize_name(wines.replace_abbreviations(key))] = value
-    print("Found {} companies at Barnivore".format(len(barnivore_companies_normalized)))
+    companies_at_vinmonopolet, companies_from_barnivore, _ = wines.load_prepared_datasets("produkter.csv", "liquor.json", "wine")
+    barnivore_index = CompanyIndex(companies_from_barnivore)
+    print("Found {} companies at Barnivore".format(len(companies_from_barnivore)))
     print("Possible duplicate companies at Barnivore:")
-    duplicates = find_duplicates(barnivore_companies_normalized, barnivore_id_map_normalized)
+    duplicates = find_duplicates(barnivore_index.ids_by_name.keys(), barnivore_index.ids_by_name)
     for (company, id, other_company, other_company_id, ratio) in duplicates:
-        company_original_name = find_company_name_by_id(id, companies_from_barnivore)
-        other_company_original_name = find_company_name_by_id(other_company_id, companies_from_barnivore)
-        print("{} ({}) ~ {} ({}) - {:.3f}".format(company_original_name, id, other_company_original_name,
+        print("{} ({}) ~ {} ({}) - {:.3f}".format(barnivore_index.company_name(id), id, barnivore_index.company_name(other_company_id),
                                                   other_company_id, ratio))
         print("    http://www.barnivore.com/wine/{}/company".format(id))
         print("    http://www.barnivore.com/wine/{}/company".format(other_company_id))
+    print_clusters(cluster_duplicates(duplicates), barnivore_index)
     print("\n\n")
-    companies_at_vinmonopolet = wines.load_wine_companies_from_vinmonopolet("produkter.csv")
-    vinmonopolet_companies, vinmonopolet_id_map = import_products_from_vinmonopolet(companies_at_vinmonopolet)
-    vinmonopolet_companies_normalized = [wines.normalize_name(wines.replace_abbreviations(x)) for x in vinmonopolet_companies]
-    vinmonopolet_id_map_normalized = {}
-    for key, value in vinmonopolet_id_map.items():
-        vinmonopolet_id_map_normalized[wines.normalize_name(wines.replace_abbreviations(key))] = value
-    print("Found {} companies at Vinmonopolet".format(len(vinmonopolet_companies)))
+
+    vinmonopolet_index = CompanyIndex(companies_at_vinmonopolet)
+    print("Found {} companies at Vinmonopolet".format(len(companies_at_vinmonopolet)))
     print("Possible duplicate companies at Vinmonopolet:")
-    duplicates = find_duplicates(vinmonopolet_companies_normalized, vinmonopolet_id_map_normalized)
+    duplicates = find_duplicates(vinmonopolet_index.ids_by_name.keys(), vinmonopolet_index.ids_by_name)
     counter = 1
     for (company, id, other_company, other_company_id, ratio) in duplicates:
-        company_original_name = find_company_name_by_id(id, companies_at_vinmonopolet)
-        other_company_original_name = find_company_name_by_id(other_company_id, companies_at_vinmonopolet)
-        print("{}. {} ({}) ~ {} ({}) - {:.3f}".format(counter, company_original_name, id, other_company_original_name, other_company_id, ratio))
-        print("    product ids, first company = {}".format(sorted(find_product_ids_by_company_id(id, companies_at_vinmonopolet))))
-        print("    product ids, second company = {}".format(sorted(find_product_ids_by_company_id(other_company_id, companies_at_vinmonopolet))))
+        print("{}. {} ({}) ~ {} ({}) - {:.3f}".format(counter, vinmonopolet_index.company_name(id), id,
+                                                      vinmonopolet_index.company_name(other_company_id), other_company_id, ratio))
+        print("    product ids, first company = {}".format(sorted(vinmonopolet_index.product_ids(id))))
+        print("    product ids, second company = {}".format(sorted(vinmonopolet_index.product_ids(other_company_id))))
         counter += 1
+    print_clusters(cluster_duplicates(duplicates), vinmonopolet_index)
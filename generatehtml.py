@@ -1,7 +1,15 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import argparse
+import hashlib
+import heapq
 import json
+import os
+import sys
+
+import match_store
+import winestrings as wines
 
 
 def pretty_format_region(product, subregion_count=2):
@@ -62,27 +70,54 @@ def sort_by_product_count(company_dict):
     return number_in_basis_selection
 
 
-def sort_by_product_price(product_dict):
-    price_raw = product_dict["Literpris"]  # eg. Kr. 106,53 pr. liter
-    price_numeric = trim_non_numeric(price_raw)
-    return int(price_numeric)  # eg 10653
+def parse_decimal(value):
+    """Parses Vinmonopolet's decimal numbers, eg. 12,50, returns None for anything else"""
+    try:
+        return float(value.replace(",", "."))
+    except (AttributeError, ValueError):
+        return None
 
 
-import sys
+def add_numeric_fields(product_dict):
+    """Parses the price, volume and alcohol strings of a product once, into the dev.* fields used for sorting"""
+    price_numeric = trim_non_numeric(product_dict.get("Literpris", ""))  # eg. Kr. 106,53 pr. liter
+    product_dict["dev.literpris"] = int(price_numeric) if price_numeric else None  # eg 10653
+    product_dict["dev.volum"] = parse_decimal(product_dict.get("Volum"))  # eg. 0,75
+    product_dict["dev.alkohol"] = parse_decimal(product_dict.get("Alkohol"))  # eg. 12,50
+
+
+def sort_by_product_price(product_dict):
+    if "dev.literpris" not in product_dict:
+        add_numeric_fields(product_dict)
+    price = product_dict["dev.literpris"]
+    return sys.maxsize if price is None else price
 
 
 def sort_by_trønder_kvotient(product_dict):
-    try:
-        price_raw = product_dict["Literpris"]  # eg. Kr. 106,53 pr. liter
-        price_numeric = trim_non_numeric(price_raw)
-        alchohol_percentage_raw = product_dict["Alkohol"]  # eg. 12,50
-        alchohol_percentage_numeric = float(alchohol_percentage_raw)
-        if product_dict["Varetype"].lower().find("alkoholfri") >= 0:
-            # skip these products
-            raise ValueError
-        return int(price_numeric) * alchohol_percentage_numeric / 100.0
-    except (KeyError, ValueError):
+    """The price of a liter of pure alcohol, so the lowest value is the most alcohol per krone"""
+    if "dev.literpris" not in product_dict:
+        add_numeric_fields(product_dict)
+    price = product_dict["dev.literpris"]
+    alchohol_percentage = product_dict["dev.alkohol"]
+    if price is None or not alchohol_percentage or "alkoholfri" in product_dict["Varetype"].lower():
+        # skip these products
         return sys.maxsize
+    return price / (alchohol_percentage / 100.0)
+
+
+def top_products(products_by_type, key, n=3):
+    """Returns the n products with the lowest key of each type, in order, without sorting the whole lists"""
+    return {product_type: heapq.nsmallest(n, products, key=key) for product_type, products in products_by_type.items()}
+
+
+def cheapest_products(products_by_type, n=3):
+    return top_products(products_by_type, sort_by_product_price, n)
+
+
+def most_alcohol_per_krone(products_by_type, n=3):
+    eligible = {product_type: [p for p in products if sort_by_trønder_kvotient(p) != sys.maxsize]
+                for product_type, products in products_by_type.items()}
+    return top_products(eligible, sort_by_trønder_kvotient, n)
 
 
 def trim_non_numeric(str):
@@ -97,168 +132,271 @@ def sort_by_company_name(company_dict):
     return next(iter(values))["Produsent"]
 
 
-print("""<html>
-   <head>
-       <meta charset='UTF-8'/>
-   </head>
-   <body>""")
+wine_types = {"Hvitvin": "hvitvin", "Rødvin": "rødvin", "Musserende vin": "musserende"}
+result_filenames = ["vegan-friendly-searchresult-vinmonopolet.json", "some-vegan-options-searchresult-vinmonopolet.json"]
 
-total_product_count = 0
-basisutvalg_count = 0
-all_companies = []
-for filename in ["vegan-friendly-searchresult-vinmonopolet.json", "some-vegan-options-searchresult-vinmonopolet.json"]:
-    file = open(filename, encoding='utf-8')
-    companies = json.loads(file.read())
-    file.close()
 
-    for company_dict in companies:
-        products = company_dict["products_found_at_vinmonopolet"]
-
-        if filename.find("some") >= 0:
-            # Ignore some minor entries for "some vegan options" companies, for ease of manual post-processing
-            basisutvalget = False
-            for product in products:
-                if product["Produktutvalg"] == "Basisutvalget":
-                    basisutvalget = True
-                    break
-            if basisutvalget and len(products) > 1:
+def load_result_files(filenames):
+    """Reads the result files of vegan_wine_search.py, as JSON or, for .jsonl files, as JSON Lines"""
+    results = []
+    for filename in filenames:
+        with open(filename, encoding='utf-8') as file:
+            companies = wines.load_result_lines(file) if filename.endswith(".jsonl") else json.load(file)
+        for company in companies:
+            for product in company["products_found_at_vinmonopolet"]:
+                add_numeric_fields(product)
+        results.append((filename, companies))
+    return results
+
+
+def load_results_from_store(filename, category="wine"):
+    """Like load_result_files, but queries the store written by vegan_wine_search.py, and leaves out rejected matches"""
+    store = match_store.open_store(filename)
+    try:
+        companies_by_status = match_store.load_results(store, category)
+    finally:
+        store.close()
+    results = []
+    for result_filename, status in zip(result_filenames, match_store.statuses):
+        companies = companies_by_status[status]
+        for company in companies:
+            for product in company["products_found_at_vinmonopolet"]:
+                add_numeric_fields(product)
+        results.append((result_filename, companies))
+    return results
+
+
+def select_companies(results):
+    """Returns the companies to list, and the number of products and products in basisutvalget among them"""
+    total_product_count = 0
+    basisutvalg_count = 0
+    all_companies = []
+    for filename, companies in results:
+        for company_dict in companies:
+            products = company_dict["products_found_at_vinmonopolet"]
+            basisutvalg_products = sum(1 for product in products if product["Produktutvalg"] == "Basisutvalget")
+            basisutvalg_count += basisutvalg_products
+
+            if filename.find("some") >= 0:
+                # Ignore some minor entries for "some vegan options" companies, for ease of manual post-processing
+                if basisutvalg_products and len(products) > 1:
+                    total_product_count += len(products)
+                    all_companies.append(company_dict)
+            else:
                 total_product_count += len(products)
                 all_companies.append(company_dict)
-            for product in products:
-                if product["Produktutvalg"] == "Basisutvalget": basisutvalg_count += 1
-        else:
-            total_product_count += len(products)
-            for product in products:
-                if product["Produktutvalg"] == "Basisutvalget": basisutvalg_count += 1
-            all_companies.append(company_dict)
-
-companies_with_the_most_products = list(all_companies)
-companies_with_the_most_products.sort(key=sort_by_product_count, reverse=True)
-print("<p>De merkene som er mest vanlige og lettest å finne på Vinmonopolet er:</p>")
-print("<ul>")
-for company in companies_with_the_most_products[:9]:
-    types = set()
-    regions = set()
-    products = company["products_found_at_vinmonopolet"]
-    company_name_from_vinmonopolet = next(iter(products))["Produsent"] if products else None
-    for product in products:
-        types.add(pretty_format_type(product))
-        regions.add(pretty_format_region(product, subregion_count=1))
-    types_list = pretty_join(types)
-    regions_list = pretty_join(regions, lowercase_tail=False)
-    print("<li>%s. %s. %s (%d varer i basisutvalget)</li>" % (
-        company_name_from_vinmonopolet, types_list, regions_list, sort_by_product_count(company)))
-print("</ul>")
-
-print("<h2>Billig-liste</h2>")
-print("<a name='billig'></a>")
-print("<h3>De billigste veganske vinene</h3>")
-all_products = []
-for company in all_companies:
-    all_products += company["products_found_at_vinmonopolet"]
-
-glass_flasker_i_basis = [x for x in all_products if x["Produktutvalg"] == "Basisutvalget"]
-
-hvitvin = [x for x in glass_flasker_i_basis if x["Varetype"].lower().find("hvitvin") >= 0]
-rødvin = [x for x in glass_flasker_i_basis if x["Varetype"].lower().find("rødvin") >= 0]
-musserende = [x for x in glass_flasker_i_basis if x["Varetype"].lower().find("musserende") >= 0]
-typer = {"Hvitvin": hvitvin, "Rødvin": rødvin, "Musserende vin": musserende}
-for vintype, viner in typer.items():
-    viner.sort(key=sort_by_product_price)
-    print(vintype)
-    print("<ul>")
-    for i in range(0, min(len(viner), 3)):
-        product = viner[i]
-        print("<li><a href='%s'>%s</a>. %s fra %s produsert av %s (kr %s, %sL, %s)</li>" % (
-            product["Vareurl"], product["Varenavn"], product["Varetype"], product["Land"], product["Produsent"],
-            product["Pris"].lower(),
-            product["Volum"].lower(),
-            product["Emballasjetype"].lower())
-        )
-    print("</ul>")
-
-print("<h3>Mest alkohol per krone</h3>")
-all_products = []
-for company in all_companies:
-    all_products += company["products_found_at_vinmonopolet"]
-
-hvitvin = [x for x in all_products if x["Varetype"].lower().find("hvitvin") >= 0]
-rødvin = [x for x in all_products if x["Varetype"].lower().find("rødvin") >= 0]
-musserende = [x for x in all_products if x["Varetype"].lower().find("musserende") >= 0]
-typer = {"Hvitvin": hvitvin, "Rødvin": rødvin, "Musserende vin": musserende}
-
-hvitvin.sort(key=sort_by_trønder_kvotient)
-rødvin.sort(key=sort_by_trønder_kvotient)
-musserende.sort(key=sort_by_trønder_kvotient)
-
-for vintype, viner in typer.items():
-    viner.sort(key=sort_by_product_price)
-    print(vintype)
-    print("<ul>")
-    for i in range(0, min(len(viner), 3)):
-        product = viner[i]
-        print("<li><a href='%s'>%s</a>. %s fra %s produsert av %s (kr %s, %sL, %s)</li>" % (
-            product["Vareurl"], product["Varenavn"], product["Varetype"], product["Land"], product["Produsent"],
-            product["Pris"].lower(),
-            product["Volum"].lower(),
-            product["Emballasjetype"].lower())
-              )
-    print("</ul>")
-
-print("<a name='liste'></a>")
-
-print(
-    "<p>Vinmonopolet har %d veganske viner fra %d produsenter. %d av disse vinene er i basisutvalget, som er ekstra lett å få tak i.</p>" % (
-        total_product_count, len(all_companies), basisutvalg_count))
-
-for filename in ["vegan-friendly-searchresult-vinmonopolet.json", "some-vegan-options-searchresult-vinmonopolet.json"]:
-    print("<h2>Veganske vinfirma på Vinmonopolet - %s</h2>" % filename)
-    file = open(filename, encoding='utf-8')
-    companies = json.loads(file.read())
-    file.close()
-
-    companies.sort(key=sort_by_company_name)
+
+    return all_companies, total_product_count, basisutvalg_count
+
+
+def index_products_by_type(companies):
+    """Returns the products of each of the wine_types, for all products and for those in basisutvalget"""
+    all_products_by_type = {wine_type: [] for wine_type in wine_types}
+    basisutvalg_products_by_type = {wine_type: [] for wine_type in wine_types}
+    for company in companies:
+        for product in company["products_found_at_vinmonopolet"]:
+            varetype = product["Varetype"].lower()
+            in_basisutvalget = product["Produktutvalg"] == "Basisutvalget"
+            for wine_type, varetype_part in wine_types.items():
+                if varetype_part in varetype:
+                    all_products_by_type[wine_type].append(product)
+                    if in_basisutvalget:
+                        basisutvalg_products_by_type[wine_type].append(product)
+    return all_products_by_type, basisutvalg_products_by_type
+
+
+def index_products_by_country_and_type(companies):
+    """Returns {country: {type name: [(company_dict, product)]}}, in the order the products appear in companies"""
     products_by_country = {}
     for company_dict in companies:
         for product in company_dict["products_found_at_vinmonopolet"]:
-            land = product["Land"]
-            if land not in products_by_country:
-                products_by_country[land] = []
-            products_by_country[land].append((company_dict, product))
-
-    print("<ul>")
-    for country, products in products_by_country.items():
-        print("<li><a href=#{}>{}</a></li>".format(country, country))
-    print("</ul>")
-
-    for country, products in products_by_country.items():
-        print("<h3><a name='{}'>{}</a></h3>".format(country, country))
-        products_by_type = {}
-        for (company_dict, p) in products:
-            type_name = pretty_format_type(p)
-            if type_name not in products_by_type:
-                products_by_type[type_name] = []
-            products_by_type[type_name].append((company_dict, p))
+            products_by_type = products_by_country.setdefault(product["Land"], {})
+            products_by_type.setdefault(pretty_format_type(product), []).append((company_dict, product))
+    return products_by_country
+
+
+def render_product_summaries(write, products_by_type):
+    for vintype, viner in products_by_type.items():
+        write(vintype)
+        write("<ul>")
+        for product in viner:
+            write("<li><a href='%s'>%s</a>. %s fra %s produsert av %s (kr %s, %sL, %s)</li>" % (
+                product["Vareurl"], product["Varenavn"], product["Varetype"], product["Land"], product["Produsent"],
+                product["Pris"].lower(),
+                product["Volum"].lower(),
+                product["Emballasjetype"].lower())
+            )
+        write("</ul>")
+
+
+def render_section(product_type, company_products):
+    """Returns the HTML of the list of one product type in one country"""
+    lines = ["<h4>{}</h4>".format(product_type), "<ul>"]
+    for (company_dict, p) in company_products:
+        isFairtrade = p["Fairtrade"] == "true"
+        isOrganic = p["Okologisk"] == "true"
+        isEco = p["Miljosmart_emballasje"] == "true"
+        lines.append("<li>{} - <a href='{}'>{}</a> {}. Laget på {}. {} {}{}{}. {} kr. <a href='{}'>[Barnivore]</a></li>".format(
+            p["Produsent"],
+            p["Vareurl"],
+            p["Varenavn"],
+            pretty_format_district(p),
+            pretty_format_grapes(p),
+            p["Produktutvalg"].replace("Basisutvalget", "<strong>Basisutvalget</strong>"),
+            ", fairtrade" if isFairtrade else "",
+            ", økologisk" if isOrganic else "",
+            ", miljøvennlig emballasje" if isEco else "",
+            p["Pris"],
+            company_dict['barnivore_url'])
+        )
+    lines.append("</ul>")
+    return "\n".join(lines)
+
+
+def section_key(product_type, company_products):
+    """A hash of everything render_section reads, so a changed product gives a new key"""
+    digest = hashlib.sha256(product_type.encode('utf-8'))
+    for (company_dict, product) in company_products:
+        digest.update(json.dumps([company_dict['barnivore_url'], product], sort_keys=True).encode('utf-8'))
+    return digest.hexdigest()
+
+
+class FragmentCache:
+    """On-disk cache of rendered sections, keyed by section and by this module's source. prune removes the ones the last render did not use"""
+
+    # the version and section key of path, other files in the directory are left alone by prune
+    fragment_filename = re.compile(r"[0-9a-f]{16}-[0-9a-f]{32}\.html")
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.used = set()
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+        with open(__file__, mode='rb') as f:
+            self.version = hashlib.sha256(f.read()).hexdigest()[:16]
+
+    def path(self, key):
+        return os.path.join(self.directory, "{}-{}.html".format(self.version, key[:32]))
+
+    def fragment(self, key, render_function):
+        path = self.path(key)
+        self.used.add(path)
+        try:
+            with open(path, encoding='utf-8') as f:
+                self.hits += 1
+                return f.read()
+        except OSError:
+            pass
+
+        self.misses += 1
+        html = render_function()
+        temp_path = "{}.{}.tmp".format(path, os.getpid())
+        with open(temp_path, mode='w', encoding='utf-8') as f:
+            f.write(html)
+        os.replace(temp_path, path)
+        return html
+
+    def prune(self):
+        for filename in os.listdir(self.directory):
+            path = os.path.join(self.directory, filename)
+            if self.fragment_filename.fullmatch(filename) and path not in self.used:
+                os.remove(path)
+
+
+def render_company_list(write, filename, companies, fragment_cache=None):
+    write("<h2>Veganske vinfirma på Vinmonopolet - %s</h2>" % filename)
+    products_by_country = index_products_by_country_and_type(sorted(companies, key=sort_by_company_name))
+
+    write("<ul>")
+    for country in products_by_country:
+        write("<li><a href=#{}>{}</a></li>".format(country, country))
+    write("</ul>")
+
+    for country, products_by_type in products_by_country.items():
+        write("<h3><a name='{}'>{}</a></h3>".format(country, country))
         for product_type, company_products in products_by_type.items():
-            print("<h4>{}</h4>".format(product_type))
-            print("<ul>")
-            for (company_dict, p) in company_products:
-                isFairtrade = p["Fairtrade"] == "true"
-                isOrganic = p["Okologisk"] == "true"
-                isEco = p["Miljosmart_emballasje"] == "true"
-                print("<li>{} - <a href='{}'>{}</a> {}. Laget på {}. {} {}{}{}. {} kr. <a href='{}'>[Barnivore]</a></li>".format(
-                    p["Produsent"],
-                    p["Vareurl"],
-                    p["Varenavn"],
-                    pretty_format_district(p),
-                    pretty_format_grapes(p),
-                    p["Produktutvalg"].replace("Basisutvalget", "<strong>Basisutvalget</strong>"),
-                    ", fairtrade" if isFairtrade else "",
-                    ", økologisk" if isOrganic else "",
-                    ", miljøvennlig emballasje" if isEco else "",
-                    p["Pris"],
-                    company_dict['barnivore_url'])
-                )
-            print("</ul>")
-
-print("</body></html>")
+            if fragment_cache is None:
+                write(render_section(product_type, company_products))
+            else:
+                write(fragment_cache.fragment(section_key(product_type, company_products),
+                                              lambda: render_section(product_type, company_products)))
+
+
+def render(out, results, fragment_cache=None):
+    """Writes the page for the loaded result files to out, a text file. Sections are reused from fragment_cache, if given"""
+
+    def write(line):
+        out.write(line)
+        out.write("\n")
+
+    write("""<html>
+   <head>
+       <meta charset='UTF-8'/>
+   </head>
+   <body>""")
+
+    all_companies, total_product_count, basisutvalg_count = select_companies(results)
+
+    companies_with_the_most_products = sorted(all_companies, key=sort_by_product_count, reverse=True)
+    write("<p>De merkene som er mest vanlige og lettest å finne på Vinmonopolet er:</p>")
+    write("<ul>")
+    for company in companies_with_the_most_products[:9]:
+        types = set()
+        regions = set()
+        products = company["products_found_at_vinmonopolet"]
+        company_name_from_vinmonopolet = next(iter(products))["Produsent"] if products else None
+        for product in products:
+            types.add(pretty_format_type(product))
+            regions.add(pretty_format_region(product, subregion_count=1))
+        types_list = pretty_join(types)
+        regions_list = pretty_join(regions, lowercase_tail=False)
+        write("<li>%s. %s. %s (%d varer i basisutvalget)</li>" % (
+            company_name_from_vinmonopolet, types_list, regions_list, sort_by_product_count(company)))
+    write("</ul>")
+
+    all_products_by_type, basisutvalg_products_by_type = index_products_by_type(all_companies)
+
+    write("<h2>Billig-liste</h2>")
+    write("<a name='billig'></a>")
+    write("<h3>De billigste veganske vinene</h3>")
+    render_product_summaries(write, cheapest_products(basisutvalg_products_by_type))
+
+    write("<h3>Mest alkohol per krone</h3>")
+    render_product_summaries(write, most_alcohol_per_krone(all_products_by_type))
+
+    write("<a name='liste'></a>")
+
+    write(
+        "<p>Vinmonopolet har %d veganske viner fra %d produsenter. %d av disse vinene er i basisutvalget, som er ekstra lett å få tak i.</p>" % (
+            total_product_count, len(all_companies), basisutvalg_count))
+
+    for filename, companies in results:
+        render_company_list(write, filename, companies, fragment_cache)
+
+    write("</body></html>")
+
+
+def write_html(output_filename, filenames=result_filenames, cache_dir=None, store=None):
+    results = load_results_from_store(store) if store else load_result_files(filenames)
+    fragment_cache = FragmentCache(cache_dir) if cache_dir else None
+    if output_filename == "-":
+        render(sys.stdout, results, fragment_cache)
+    else:
+        with open(output_filename, mode='w', encoding='utf-8', buffering=1024 * 1024) as out:
+            render(out, results, fragment_cache)
+    if fragment_cache:
+        fragment_cache.prune()
+        print("Reused {} of {} sections from {}".format(
+            fragment_cache.hits, fragment_cache.hits + fragment_cache.misses, cache_dir), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate a HTML page from the result files of vegan_wine_search.py")
+    parser.add_argument("-o", "--output", default="-", help="the HTML file to write (default: stdout)")
+    parser.add_argument("--cache", metavar="DIR", help="keep rendered sections in DIR, and only re-render the sections whose products changed")
+    parser.add_argument("--store", help="read the matches from this SQLite file written by vegan_wine_search.py, instead of the result files")
+    parser.add_argument("--results", nargs="+", default=result_filenames, metavar="FILE",
+                        help="the result files to read, .json or .jsonl (default: %(default)s)")
+    args = parser.parse_args()
+    write_html(args.output, args.results, cache_dir=args.cache, store=args.store)
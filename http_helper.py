@@ -4,6 +4,17 @@
 from bs4 import BeautifulSoup
 import string
 import logging
+from concurrent.futures import ThreadPoolExecutor
+from collections import namedtuple
+from itertools import repeat
+from timeit import default_timer as timer
+import hashlib
+import json
+import os
+import queue
+import re
+import threading
+import time
 
 logger = logging.getLogger()
 
@@ -23,41 +34,295 @@ import urllib3
 
 urllib3.disable_warnings()
 import requests
-from urllib.parse import urlparse
+import requests.adapters
+import requests.structures
+from urllib.parse import urlparse, urlunparse
 
 
-def get_webpage(url, identifier=None, name=None):
+# use a fake custom user agent string to avoid silly webpages rejecting the library's default agent string
+custom_user_agent = {"User-Agent": "Mozilla/5.0 (Windows NT 6.1; WOW64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/60.0.3112.90 Safari/537.36"}
+
+
+def create_session(max_connections_per_host=4, max_hosts=128):
+    """A session with keep-alive connection pooling, shared by all threads doing requests"""
+    session = requests.Session()
+    session.headers.update(custom_user_agent)
+    session.verify = False
+    # pool_block makes max_connections_per_host a hard cap instead of a number of connections to keep alive
+    adapter = requests.adapters.HTTPAdapter(pool_connections=max_hosts, pool_maxsize=max_connections_per_host, pool_block=True)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+class ResponseCache:
+    """On-disk cache of successful responses by normalized url, revalidated after ttl seconds and evicted after max_age or beyond max_bytes"""
+
+    # entries are named after the sha1 of their url, see key
+    entry_filename = re.compile(r"[0-9a-f]{40}\.json")
+    entry_fields = ["url", "final_url", "status", "headers", "encoding", "etag", "last_modified", "fetched_at", "size"]
+
+    def __init__(self, directory, ttl=24 * 3600, max_age=30 * 24 * 3600, max_bytes=512 * 1024 * 1024):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+        self.sizes = {}  # key -> (fetched_at, body size)
+        for filename in os.listdir(directory):
+            # other files in the directory are left alone
+            if self.entry_filename.fullmatch(filename):
+                entry = self.load_entry(filename[:-len(".json")])
+                if entry:
+                    self.sizes[entry["key"]] = (entry["fetched_at"], entry["size"])
+        self.evict()
+
+    @staticmethod
+    def normalize_url(url):
+        parts = urlparse(url.strip())
+        scheme = parts.scheme.lower() or "http"
+        netloc = parts.netloc.lower()
+        if (scheme, parts.port) in (("http", 80), ("https", 443)):
+            netloc = netloc.rsplit(":", 1)[0]
+        return urlunparse((scheme, netloc, parts.path or "/", parts.params, parts.query, ""))
+
+    def key(self, url):
+        return hashlib.sha1(self.normalize_url(url).encode('utf-8')).hexdigest()
+
+    def path(self, key, extension):
+        return os.path.join(self.directory, key + extension)
+
+    def load_entry(self, key):
+        try:
+            with open(self.path(key, ".json"), encoding='utf-8') as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if not isinstance(entry, dict) or entry.get("key") != key or any(x not in entry for x in self.entry_fields):
+            return None
+        return entry
+
+    def load_body(self, key):
+        try:
+            with open(self.path(key, ".body"), mode='rb') as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def write_file(self, path, data, mode):
+        temp_path = "{}.{}.tmp".format(path, threading.get_ident())
+        with open(temp_path, mode=mode, **({} if 'b' in mode else {"encoding": 'utf-8'})) as f:
+            f.write(data)
+        os.replace(temp_path, path)
+
+    def store(self, key, url, response):
+        entry = {"key": key,
+                 "url": url,
+                 "final_url": response.url,
+                 "status": response.status_code,
+                 "headers": dict(response.headers),
+                 "encoding": response.encoding,
+                 "etag": response.headers.get("ETag"),
+                 "last_modified": response.headers.get("Last-Modified"),
+                 "fetched_at": time.time(),
+                 "size": len(response.content)}
+        self.write_file(self.path(key, ".body"), response.content, 'wb')
+        self.write_file(self.path(key, ".json"), json.dumps(entry), 'w')
+        with self.lock:
+            self.sizes[key] = (entry["fetched_at"], entry["size"])
+        self.evict()
+
+    def touch(self, key, entry):
+        entry["fetched_at"] = time.time()
+        self.write_file(self.path(key, ".json"), json.dumps(entry), 'w')
+        with self.lock:
+            self.sizes[key] = (entry["fetched_at"], entry["size"])
+
+    def remove(self, key):
+        self.sizes.pop(key, None)
+        for extension in [".json", ".body"]:
+            try:
+                os.remove(self.path(key, extension))
+            except OSError:
+                pass
+
+    def evict(self):
+        with self.lock:
+            oldest_allowed = time.time() - self.max_age
+            for key in [k for k, (fetched_at, _) in self.sizes.items() if fetched_at < oldest_allowed]:
+                self.remove(key)
+
+            total_size = sum(size for _, size in self.sizes.values())
+            if total_size > self.max_bytes:
+                for key, (_, size) in sorted(self.sizes.items(), key=lambda x: x[1][0]):
+                    self.remove(key)
+                    total_size -= size
+                    if total_size <= self.max_bytes:
+                        break
+
+    @staticmethod
+    def to_response(entry, body):
+        response = requests.Response()
+        response.status_code = entry["status"]
+        response.url = entry["final_url"]
+        response.headers = requests.structures.CaseInsensitiveDict(entry["headers"])
+        response.encoding = entry["encoding"]
+        response._content = body
+        return response
+
+    def get(self, http, url):
+        key = self.key(url)
+        entry = self.load_entry(key)
+        body = self.load_body(key) if entry else None
+        if body is None:
+            entry = None
+        elif time.time() - entry["fetched_at"] < self.ttl:
+            return self.to_response(entry, body)
+
+        headers = dict(custom_user_agent)
+        if entry and entry["etag"]:
+            headers["If-None-Match"] = entry["etag"]
+        if entry and entry["last_modified"]:
+            headers["If-Modified-Since"] = entry["last_modified"]
+
+        response = http.get(url, headers=headers, verify=False, timeout=30)
+        if response.status_code == 304 and entry:
+            self.touch(key, entry)
+            return self.to_response(entry, body)
+        if response.status_code == 200:
+            self.store(key, url, response)
+        return response
+
+
+response_cache = None
+
+
+def enable_cache(directory, **options):
+    """Opt in to caching the web pages fetched by get_webpage and friends, see ResponseCache for the options"""
+    global response_cache
+    response_cache = ResponseCache(directory, **options)
+    return response_cache
+
+
+def fetch(http, url):
+    if response_cache is not None:
+        return response_cache.get(http, url)
+    return http.get(url, headers=custom_user_agent, verify=False, timeout=30)
+
+
+def get_webpage(url, identifier=None, name=None, session=None):
+    return get_response(url, identifier, name, session).text
+
+
+def get_response(url, identifier=None, name=None, session=None):
     if not urlparse(url).scheme:
         url = "http://" + url
 
-    # use a fake custom user agent string to avoid silly webpages rejecting the library's default agent string
-    custom_user_agent = {"User-Agent": "Mozilla/5.0 (Windows NT 6.1; WOW64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/60.0.3112.90 Safari/537.36"}
-    r = requests.get(url, headers=custom_user_agent, verify=False, timeout=30)
+    http = session or requests
+    r = fetch(http, url)
     if r.status_code // 100 != 2:
         root_page = urlparse(url)
         new_url = "{}://{}".format(root_page.scheme, root_page.netloc)
-        r2 = requests.get(new_url, headers=custom_user_agent, verify=False, timeout=30)
+        r2 = fetch(http, new_url)
         if r2.status_code // 100 == 2:
             logging.info("Error retrieving url={}, id={}, name={}, but {} worked".format(url, identifier, name, new_url))
-        elif root_page.scheme is "http":
+        elif root_page.scheme == "http":
             logging.debug("Retrying with https scheme, url={}".format(root_page.netloc))
             new_url = "{}://{}".format("https", root_page.netloc)
-            r3 = requests.get(new_url, headers=custom_user_agent, verify=False, timeout=30)
+            r3 = fetch(http, new_url)
             if r3.status_code // 100 == 2:
                 logging.info("error retrieving url={}, id={}, name={}, but {} worked".format(url, identifier, name, new_url))
             r3.raise_for_status()
         r2.raise_for_status()
     r.raise_for_status()
-    return r.text
+    return r
+
 
+UrlCheck = namedtuple("UrlCheck", ["url", "status", "final_url", "latency", "error"])
 
-def get_title(url):
+
+def check_url(url, session, identifier=None, name=None):
+    start = timer()
     try:
-        body = get_webpage(url)
+        response = get_response(url, identifier, name, session)
+        return UrlCheck(url, response.status_code, response.url, timer() - start, None)
+    except requests.exceptions.RequestException as ex:
+        response = ex.response
+        return UrlCheck(url,
+                        response.status_code if response is not None else None,
+                        response.url if response is not None else None,
+                        timer() - start,
+                        type(ex).__name__)
+
+
+def check_urls(urls, max_concurrent=32, max_connections_per_host=4, identifiers=None, names=None):
+    """Checks urls concurrently over a pooled session, returns a UrlCheck per url in the same order"""
+    if not urls:
+        return []
+    identifiers = identifiers or [None] * len(urls)
+    names = names or [None] * len(urls)
+    with create_session(max_connections_per_host) as session:
+        with ThreadPoolExecutor(max_workers=min(max_concurrent, len(urls))) as executor:
+            return list(executor.map(check_url, urls, repeat(session), identifiers, names))
+
+
+def get_title(url, session=None):
+    try:
+        body = get_webpage(url, session=session)
         if body:
             return parse_title(body)
         else:
             return None
     except requests.exceptions.RequestException as ex:
-        logging.debug("Error retrieving web page: {} ".format(type(ex)))
+        logging.debug("Error retrieving web page: {} ".format(type(ex)))
         return None
+
+
+def get_titles(urls, max_workers=16, latencies=None, deadline=60):
+    """Looks up the titles of web pages concurrently, in the order of urls, with None for the lookups not done by the deadline"""
+    if not urls:
+        return []
+    titles = [None] * len(urls)
+    lookup_seconds = []
+    remaining = len(urls)
+    pending = queue.Queue()
+    for position, url in enumerate(urls):
+        pending.put((position, url))
+    done = threading.Condition()
+    stopped = threading.Event()
+    session = create_session()
+
+    def look_up_titles():
+        nonlocal remaining
+        while not stopped.is_set():
+            try:
+                position, url = pending.get_nowait()
+            except queue.Empty:
+                return
+            start = timer()
+            try:
+                title = get_title(url, session)
+            except Exception as ex:
+                logging.debug("Error looking up title of {}: {}".format(url, type(ex)))
+                title = None
+            with done:
+                if stopped.is_set():
+                    return
+                titles[position] = title
+                lookup_seconds.append(timer() - start)
+                remaining -= 1
+                done.notify()
+
+    # daemon threads, so that lookups still running at the deadline do not hold up the exit
+    for _ in range(min(max_workers, len(urls))):
+        threading.Thread(target=look_up_titles, daemon=True).start()
+    with done:
+        done.wait_for(lambda: remaining == 0, timeout=deadline)
+        stopped.set()
+        if remaining:
+            logging.info("Gave up {} title lookups after {}s".format(remaining, deadline))
+        if latencies is not None:
+            latencies.extend(lookup_seconds)
+        return list(titles)
@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import argparse
+import json
+import sqlite3
+import sys
+import time
+
+import winestrings as wines
+
+default_store_filename = "vegan-wine-search.sqlite"
+statuses = ["Vegan Friendly", "Has Some Vegan Options"]
+
+schema = """
+create table if not exists products (
+    varenummer text primary key,
+    produsent text not null,
+    land text,
+    varetype text,
+    produktutvalg text,
+    data text not null
+);
+create index if not exists products_produsent on products (produsent);
+create index if not exists products_land on products (land);
+create index if not exists products_varetype on products (varetype);
+
+create table if not exists companies (
+    category text not null,
+    id integer not null,
+    company_name text not null,
+    status text,
+    country text,
+    data text not null,
+    primary key (category, id)
+);
+create index if not exists companies_company_name on companies (company_name);
+
+create table if not exists candidate_matches (
+    category text not null,
+    company_id integer not null,
+    produsent text not null,
+    normalized_name_score integer,
+    search_string_score integer,
+    outcome text not null,
+    position integer,
+    primary key (category, company_id, produsent)
+);
+create index if not exists candidate_matches_produsent on candidate_matches (produsent);
+create index if not exists candidate_matches_outcome on candidate_matches (category, outcome, position);
+
+create table if not exists match_products (
+    category text not null,
+    company_id integer not null,
+    varenummer text not null,
+    position integer not null,
+    primary key (category, company_id, varenummer)
+);
+create index if not exists match_products_varenummer on match_products (varenummer);
+
+create table if not exists decisions (
+    category text not null,
+    company_id integer not null,
+    produsent text not null,
+    decision text not null check (decision in ('accept', 'reject')),
+    note text,
+    decided_at real not null,
+    primary key (category, company_id, produsent)
+);
+"""
+
+
+def open_store(filename=default_store_filename):
+    connection = sqlite3.connect(filename)
+    connection.row_factory = sqlite3.Row
+    connection.executescript(schema)
+    return connection
+
+
+def write_run(connection, category, companies_from_barnivore, matched_companies, candidate_log=None, rescored_company_ids=None):
+    """
+    Replaces the companies, candidate matches and matched products of category with the ones from a run, decisions are kept.
+    Only the products of matched companies are stored.
+    After an incremental run, pass the ids of the rescored companies, the candidate matches of the others are kept
+    """
+    with connection:
+        for table in ["companies", "match_products"]:
+            connection.execute("delete from {} where category = ?".format(table), (category,))
+        if rescored_company_ids is None:
+            connection.execute("delete from candidate_matches where category = ?", (category,))
+        else:
+            kept_ids = {x["id"] for x in companies_from_barnivore} - set(rescored_company_ids)
+            connection.execute("delete from candidate_matches where category = ? and company_id not in ({})".format(
+                ", ".join(str(int(x)) for x in kept_ids)), (category,))
+            connection.execute("update candidate_matches set position = null where category = ?", (category,))
+
+        connection.executemany(
+            "insert into companies (category, id, company_name, status, country, data) values (?, ?, ?, ?, ?, ?)",
+            ((category, x["id"], x["company_name"], x["status"], x["country"],
+              json.dumps({k: v for k, v in x.items() if k != "products_found_at_vinmonopolet"}, ensure_ascii=False, default=wines.to_json))
+             for x in companies_from_barnivore))
+
+        connection.executemany(
+            "insert or replace into candidate_matches (category, company_id, produsent, normalized_name_score, search_string_score, outcome) "
+            "values (?, ?, ?, ?, ?, ?)",
+            ((category, x["company_id"], x["produsent"], x["normalized_name_score"], x["search_string_score"], x["outcome"])
+             for x in candidate_log or []))
+
+        for position, company in enumerate(matched_companies):
+            products = company.get("products_found_at_vinmonopolet")
+            if not products:
+                continue
+            produsent = products[0]["Produsent"]
+            # the candidate matches of companies carried forward by an incremental run are kept from the earlier run,
+            # unless that run did not write this store
+            connection.execute("insert or ignore into candidate_matches (category, company_id, produsent, outcome) values (?, ?, ?, 'selected')",
+                               (category, company["id"], produsent))
+            connection.execute("update candidate_matches set position = ? where category = ? and company_id = ? and produsent = ?",
+                               (position, category, company["id"], produsent))
+            connection.executemany(
+                "insert or replace into products (varenummer, produsent, land, varetype, produktutvalg, data) values (?, ?, ?, ?, ?, ?)",
+                ((p["Varenummer"], p["Produsent"], p["Land"], p["Varetype"], p["Produktutvalg"],
+                  json.dumps(p, ensure_ascii=False, default=wines.to_json)) for p in products))
+            connection.executemany("insert into match_products (category, company_id, varenummer, position) values (?, ?, ?, ?)",
+                                   ((category, company["id"], p["Varenummer"], i) for i, p in enumerate(products)))
+        # products of companies that are no longer matched in any category
+        connection.execute("delete from products where varenummer not in (select varenummer from match_products)")
+
+
+def load_results(connection, category="wine", include_rejected=False):
+    """Returns {status: companies} for the selected matches of category like the result files, without the rejected ones"""
+    products_by_company = {}
+    for row in connection.execute("select m.company_id, p.data from match_products m join products p on p.varenummer = m.varenummer "
+                                  "where m.category = ? order by m.company_id, m.position", (category,)):
+        products_by_company.setdefault(row["company_id"], []).append(json.loads(row["data"]))
+
+    results = {status: [] for status in statuses}
+    for row in connection.execute("select c.data, c.status, d.decision from candidate_matches m "
+                                  "join companies c on c.category = m.category and c.id = m.company_id "
+                                  "left join decisions d on d.category = m.category and d.company_id = m.company_id and d.produsent = m.produsent "
+                                  "where m.category = ? and m.outcome = 'selected' and m.position is not null order by m.position", (category,)):
+        if row["status"] not in results or (row["decision"] == "reject" and not include_rejected):
+            continue
+        company = json.loads(row["data"])
+        company["products_found_at_vinmonopolet"] = products_by_company.get(company["id"], [])
+        results[row["status"]].append(company)
+    return results
+
+
+def export_json(connection, category, outputfile_all_vegan, outputfile_some_vegan):
+    """Writes the result files of vegan_wine_search.py from the store, without the rejected matches"""
+    results = load_results(connection, category)
+    for filename, status in zip([outputfile_all_vegan, outputfile_some_vegan], statuses):
+        with open(filename, mode='w', encoding='utf-8') as f:
+            json.dump(results[status], f, indent=2, ensure_ascii=False, sort_keys=True)
+        print("Wrote {} companies to {}".format(len(results[status]), filename))
+
+
+def decide(connection, category, company_id, decision, note=None):
+    """Records a reviewer's decision on the selected match of a company, returns the matched Vinmonopolet company or None"""
+    row = connection.execute("select produsent from candidate_matches where category = ? and company_id = ? and outcome = 'selected'",
+                             (category, company_id)).fetchone()
+    if not row:
+        return None
+    with connection:
+        connection.execute("insert or replace into decisions (category, company_id, produsent, decision, note, decided_at) values (?, ?, ?, ?, ?, ?)",
+                           (category, company_id, row["produsent"], decision, note, time.time()))
+    return row["produsent"]
+
+
+def list_matches(connection, category="wine", country=None):
+    """Returns the selected matches of category as rows, optionally only those with products from country"""
+    query = ("select m.company_id, c.company_name, m.produsent, m.normalized_name_score, m.search_string_score, d.decision "
+             "from candidate_matches m join companies c on c.category = m.category and c.id = m.company_id "
+             "left join decisions d on d.category = m.category and d.company_id = m.company_id and d.produsent = m.produsent "
+             "where m.category = ? and m.outcome = 'selected'")
+    parameters = [category]
+    if country:
+        query += (" and exists (select 1 from match_products mp join products p on p.varenummer = mp.varenummer "
+                  "where mp.category = m.category and mp.company_id = m.company_id and p.land = ?)")
+        parameters.append(country)
+    return connection.execute(query + " order by m.position", parameters).fetchall()
+
+
+if __name__ == "__main__":
+    import vegan_wine_search
+
+    parser = argparse.ArgumentParser(description="Review the matches stored by vegan_wine_search.py, and export them as JSON")
+    parser.add_argument("--store", default=default_store_filename, help="the SQLite file (default: %(default)s)")
+    parser.add_argument("--category", default="wine", choices=list(wines.barnivore_filenames))
+    commands = parser.add_subparsers(dest="command")
+    commands.required = True
+    list_parser = commands.add_parser("list", help="list the selected matches, with their scores and decisions")
+    list_parser.add_argument("--country", help="only matches with products from this country, as in the Land column")
+    for decision in ["accept", "reject"]:
+        decision_parser = commands.add_parser(decision, help="{} the selected match of a Barnivore company".format(decision))
+        decision_parser.add_argument("company_id", type=int, help="the Barnivore company id")
+        decision_parser.add_argument("--note")
+    commands.add_parser("export", help="write the result files of the category, without the rejected matches")
+    args = parser.parse_args()
+
+    store = open_store(args.store)
+    if args.command == "list":
+        for row in list_matches(store, args.category, args.country):
+            print("{}\t{}\t{}\t{}\t{}\t{}".format(row["company_id"], row["company_name"], row["produsent"],
+                                                  row["normalized_name_score"], row["search_string_score"], row["decision"] or ""))
+    elif args.command == "export":
+        export_json(store, args.category, *vegan_wine_search.output_filenames(args.category))
+    else:
+        produsent = decide(store, args.category, args.company_id, args.command, args.note)
+        if not produsent:
+            sys.exit("No selected match for company id {} in {}".format(args.company_id, args.category))
+        print("{}ed the match of company id {} with '{}'".format(args.command.capitalize(), args.company_id, produsent))
@@ -2,33 +2,121 @@
 # -*- coding: utf-8 -*-
 
 import json
+import hashlib
+import os
+import sys
+import resource
+import tracemalloc
+from collections import Counter
+from contextlib import contextmanager
 from timeit import default_timer as timer
 import winestrings as wines
 
 import multiprocessing
-from itertools import repeat
+import argparse
 import http_helper
+import match_store
 
 vegan_friendly_output_filename = "vegan-friendly-searchresult-vinmonopolet.json"
 some_vegan_products_output_filename = "some-vegan-options-searchresult-vinmonopolet.json"
+# the part of the Barnivore company urls for each category
+barnivore_sections = {"wine": "wine", "beer": "beer", "spirits": "liquor"}
+
+# possible_name_matches requires a search string ratio of at least this
+name_match_min_ratio = 86
+# Barnivore contains many USA and Canada companies, but Vinmonopolet does not, so these are only
+# matched with Vinmonopolet companies that have products from the same country
+same_country_only = {"usa", "canada"}
+# seconds to wait for all the website title lookups of a run, the ones not done by then get no title
+title_lookup_deadline = 60
+metrics_output_filename = "vegan-wine-search-metrics.json"
+
+# Filled in during a run, and written as JSON by write_metrics_file
+run_metrics = {"stages": {}, "counters": Counter(), "http_lookup_seconds": [], "pool": []}
+
+
+def max_rss_mb():
+    # the most memory the processes used at any time so far, ru_maxrss is in kilobytes on Linux, and in bytes on Mac
+    scale = 1024 * 1024 if sys.platform == "darwin" else 1024
+    return {"self": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale,
+            "pool_workers": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / scale}
+
+
+# The peak traced memory of each stage being measured, innermost last, with --trace-memory
+active_stage_peaks = []
+
+
+@contextmanager
+def measure_stage(name):
+    tracing = tracemalloc.is_tracing()
+    if tracing:
+        # reset_peak also resets the peak of the enclosing stage, so keep it first
+        if active_stage_peaks:
+            active_stage_peaks[-1] = max(active_stage_peaks[-1], tracemalloc.get_traced_memory()[1])
+        tracemalloc.reset_peak()
+        active_stage_peaks.append(0)
+    start = timer()
+    yield
+    run_metrics["stages"][name] = {"seconds": timer() - start, "max_rss_mb": max_rss_mb()}
+    if tracing:
+        peak = max(active_stage_peaks.pop(), tracemalloc.get_traced_memory()[1])
+        if active_stage_peaks:
+            active_stage_peaks[-1] = max(active_stage_peaks[-1], peak)
+        run_metrics["stages"][name]["peak_traced_memory_mb"] = peak / (1024 * 1024)
+
+
+def percentiles(values, points=(50, 90, 99, 100)):
+    ordered = sorted(values)
+    if not ordered:
+        return {}
+    return {"p{}".format(x): ordered[min(len(ordered) - 1, int(len(ordered) * x / 100))] for x in points}
+
+
+def write_metrics_file(filename):
+    metrics = {"stages": run_metrics["stages"],
+               "counters": dict(run_metrics["counters"]),
+               "http_lookups": dict(count=len(run_metrics["http_lookup_seconds"]), **percentiles(run_metrics["http_lookup_seconds"])),
+               "pool": run_metrics["pool"]}
+    with open(filename, mode='w', encoding='utf-8') as f:
+        json.dump(metrics, f, indent=2)
+    print("Wrote run metrics to {}".format(filename))
+
+
+def possible_name_matches(companies, other_company):
+    """Returns a boolean array with one element per company, true for the ones whose names may match other_company"""
+    return possible_search_string_matches([x["dev.search_string"] for x in companies], other_company["dev.search_string"])
+
+
+def possible_search_string_matches(names, other_name, min_ratio=name_match_min_ratio, prepared_names=None, prepared_other_name=None):
+    # prepared_names and prepared_other_name are the names after wines.prepare_for_ratio, if the caller has them
+    matches = wines.lcs_matrix(names, [other_name])[:, 0] >= 4
+    if matches.any():
+        if prepared_names is None:
+            prepared_names = [wines.prepare_for_ratio(x) for x in names]
+            prepared_other_name = wines.prepare_for_ratio(other_name)
+        ratios = wines.ratio_matrix([x for x, match in zip(prepared_names, matches) if match], [prepared_other_name],
+                                    min_ratio=min_ratio, prepared=True)[:, 0]
+        matches[matches] = ratios >= min_ratio
+    return matches
+
+
+def output_filenames(category, output_format="json"):
+    """The two result files for a category, the wine results keep their original names"""
+    suffix = "" if category == "wine" else "-{}".format(category)
+    return tuple(x.replace(".json", "{}.{}".format(suffix, output_format)) for x in [vegan_friendly_output_filename, some_vegan_products_output_filename])
+
+
+def write_result_file(enriched_company_list, outputfile_all_vegan, outputfile_some_vegan, category="wine", output_format="json"):
+    """Writes the matched companies to the two result files, as JSON Lines with output_format jsonl"""
+    if output_format == "jsonl":
+        write_result_lines(enriched_company_list, outputfile_all_vegan, outputfile_some_vegan, category)
+        return
 
-
-def possible_name_match(vegan_company, vinmonopolet_company):
-    a_name = vegan_company["dev.search_string"]
-    another_name = vinmonopolet_company["dev.search_string"]
-    possible_name_match = wines.lcs(a_name, another_name) >= 4 \
-                          and wines.name_similarity(a_name, another_name) > 85
-
-    return possible_name_match
-
-
-def write_result_file(enriched_company_list, outputfile_all_vegan, outputfile_some_vegan):
     all_vegan_companies = []
     partly_vegan_companies = []
     for company in enriched_company_list:
         if "products_found_at_vinmonopolet" in company:
-            company['dev.countries'] = list(company['dev.countries'])  # convert set to list for JSON serialization to work
-            company['barnivore_url'] = "http://www.barnivore.com/wine/%s/company" % company['id']  # to simplify lookups later
+            add_result_fields(company, category)
             status = company["status"]
             if status == 'Has Some Vegan Options':
                 partly_vegan_companies.append(company)
@@ -36,134 +124,523 @@ def write_result_file(enriched_company_list, outputfile_all_vegan, outputfile_so
                 all_vegan_companies.append(company)
 
     with open(outputfile_all_vegan, mode='w', encoding='utf-8') as f:
-        json.dump(all_vegan_companies, f, indent=2, ensure_ascii=False, sort_keys=True)
+        json.dump(all_vegan_companies, f, indent=2, ensure_ascii=False, sort_keys=True, default=wines.to_json)
         f.flush()
-    print("Found {} possible vegan wine company matches".format(len(all_vegan_companies)))
+    print("Found {} possible vegan {} company matches".format(len(all_vegan_companies), category))
 
     with open(outputfile_some_vegan, mode='w', encoding='utf-8') as f:
-        json.dump(partly_vegan_companies, f, indent=2, ensure_ascii=False, sort_keys=True)
+        json.dump(partly_vegan_companies, f, indent=2, ensure_ascii=False, sort_keys=True, default=wines.to_json)
         f.flush()
-    print("Found {} possible matches for wine companies with some vegan options".format(len(partly_vegan_companies)))
-
-
-def find_possible_matches(company_tuple_list):
-    possible_name_matches = []
-    vegan_company = None
-    for vinmonopolet_company, barnivore_company in company_tuple_list:
-        if possible_name_match(vinmonopolet_company, barnivore_company):
-            possible_name_matches.append(vinmonopolet_company)
-            vegan_company = barnivore_company
-    if possible_name_matches:
-        return (vegan_company, possible_name_matches)
-    else:
-        return None
+    print("Found {} possible matches for {} companies with some vegan options".format(len(partly_vegan_companies), category))
+
+
+def add_result_fields(company, category):
+    company['dev.countries'] = list(company['dev.countries'])  # convert set to list for JSON serialization to work
+    company['barnivore_url'] = "http://www.barnivore.com/%s/%s/company" % (barnivore_sections[category], company['id'])  # to simplify lookups later
+
+
+def write_result_lines(enriched_company_list, outputfile_all_vegan, outputfile_some_vegan, category="wine"):
+    with open(outputfile_all_vegan, mode='w', encoding='utf-8') as all_vegan_file, \
+            open(outputfile_some_vegan, mode='w', encoding='utf-8') as some_vegan_file:
+        all_vegan_writer = wines.ResultLinesWriter(all_vegan_file)
+        partly_vegan_writer = wines.ResultLinesWriter(some_vegan_file)
+        for company in enriched_company_list:
+            if "products_found_at_vinmonopolet" in company:
+                add_result_fields(company, category)
+                status = company["status"]
+                if status == 'Has Some Vegan Options':
+                    partly_vegan_writer.write(company)
+                elif (status == 'Vegan Friendly'):
+                    all_vegan_writer.write(company)
+    print("Found {} possible vegan {} company matches".format(all_vegan_writer.company_count, category))
+    print("Found {} possible matches for {} companies with some vegan options".format(partly_vegan_writer.company_count, category))
+
+
+# Set in each pool worker by init_worker, {category: name_table(...)}
+worker_name_tables = {}
 
 
-def find_possible_company_matches(vegan_companies, wine_companies_at_vinmonopolet):
-    dataset = []
+def name_table(vegan_companies, wine_companies_at_vinmonopolet):
+    """The part of a category's datasets the pool workers need, the search strings and country codes"""
+    return {"vinmonopolet_names": [x["dev.search_string"] for x in wine_companies_at_vinmonopolet],
+            "vinmonopolet_prepared_names": [wines.prepare_for_ratio(x["dev.search_string"]) for x in wine_companies_at_vinmonopolet],
+            "vinmonopolet_countries": [{wines.country_code(c) for c in x["dev.countries"]} for x in wine_companies_at_vinmonopolet],
+            "barnivore_names": [x["dev.search_string"] for x in vegan_companies],
+            "barnivore_prepared_names": [wines.prepare_for_ratio(x["dev.search_string"]) for x in vegan_companies],
+            "barnivore_countries": [{wines.country_code(c) for c in x["dev.countries"]} for x in vegan_companies],
+            "barnivore_same_country_only": [not same_country_only.isdisjoint(x["dev.countries"]) for x in vegan_companies],
+            "index": wines.NgramIndex(wine_companies_at_vinmonopolet)}
+
+
+def init_worker(name_tables):
+    global worker_name_tables
+    worker_name_tables = name_tables
+
+
+def find_possible_matches(task):
+    """
+    Pool task, returns the pairs of a range of Barnivore companies and their candidates passing possible_name_matches,
+    with the number of pairs compared, the number left out by country, and the time it took
+    """
+    start = timer()
+    category, first, last, candidate_limit, cross_country_min_ratio = task
+    table = worker_name_tables[category]
+    vinmonopolet_names = table["vinmonopolet_names"]
+    vinmonopolet_prepared_names = table["vinmonopolet_prepared_names"]
+    vinmonopolet_countries = table["vinmonopolet_countries"]
+    pairs = []
+    pair_count = 0
+    excluded_count = 0
+    for barnivore_position in range(first, last):
+        name = table["barnivore_names"][barnivore_position]
+        candidates = table["index"].candidates(name, limit=candidate_limit)
+        if not candidates:
+            continue
+        # candidates without a country in common need cross_country_min_ratio, and none for same_country_only companies
+        countries = table["barnivore_countries"][barnivore_position]
+        same_country = [i for i in candidates if not countries.isdisjoint(vinmonopolet_countries[i])]
+        other_countries = [i for i in candidates if countries.isdisjoint(vinmonopolet_countries[i])]
+        if table["barnivore_same_country_only"][barnivore_position] or cross_country_min_ratio > 100:
+            excluded_count += len(other_countries)
+            other_countries = []
+
+        matched = set()
+        for partition, min_ratio in [(same_country, name_match_min_ratio), (other_countries, max(name_match_min_ratio, cross_country_min_ratio))]:
+            if partition:
+                pair_count += len(partition)
+                matches = possible_search_string_matches([vinmonopolet_names[i] for i in partition], name, min_ratio,
+                                                         [vinmonopolet_prepared_names[i] for i in partition],
+                                                         table["barnivore_prepared_names"][barnivore_position])
+                matched.update(partition[i] for i in matches.nonzero()[0])
+        pairs.extend((barnivore_position, i) for i in candidates if i in matched)
+    return pairs, pair_count, excluded_count, timer() - start
+
+
+def report_candidate_recall(vegan_companies, wine_companies_at_vinmonopolet, index, candidate_limit=None):
+    """Compares the candidates from the n-gram index with a slow all-pairs run of possible_name_matches"""
+    all_pairs_matches = 0
+    found_by_index = 0
     for vegan_company in vegan_companies:
-        combinations = zip(wine_companies_at_vinmonopolet, repeat(vegan_company))
-        dataset.append(combinations)
+        candidates = set(index.candidates(vegan_company["dev.search_string"], limit=candidate_limit))
+        matches = possible_name_matches(wine_companies_at_vinmonopolet, vegan_company)
+        for position in matches.nonzero()[0]:
+            all_pairs_matches += 1
+            if position in candidates:
+                found_by_index += 1
+
+    recall = found_by_index / all_pairs_matches if all_pairs_matches else 1.0
+    print("Candidate index recall: {:.3f} ({} of {} all-pairs name matches)".format(recall, found_by_index, all_pairs_matches))
+    return recall
 
+
+def create_pool(name_tables):
+    """A worker pool with the name tables of each category, sent to every worker once instead of with every task"""
     num_agents = multiprocessing.cpu_count() - 1 or 1
-    chunk_size = int(len(dataset) / num_agents + 0.5)
-    with multiprocessing.Pool(processes=num_agents) as pool:
-        result = pool.map(find_possible_matches, dataset, chunk_size)
-
-        filtered_list = [x for x in result if x]  # remove empty items
-
-        for vegan_company, vinmonopolet_companies in filtered_list:
-            vegan_company_name = vegan_company["company_name"]
-            # print("Searching for company '{}' ('{}') at Vinmonopolet...".format(vegan_company_name, vegan_company["dev.search_string"]))
-
-            possible_matches = []
-            for candidate in vinmonopolet_companies:
-                vinmonopolet_company_name = candidate["company_name"]
-                normalized_name_similarity = wines.name_similarity(vegan_company["dev.normalized_name"], candidate["dev.normalized_name"])
-                search_name_similarity = wines.name_similarity(vegan_company["dev.search_string"], candidate["dev.search_string"])
-                close_name_match = search_name_similarity > 0.9
-
-                if (not close_name_match and normalized_name_similarity < 0.65) or normalized_name_similarity < 0.45:
-                    print("Warning: ignoring match between companies '{}' and '{}', listed names vary too much - {:.3f}, {:.3f}".format(vegan_company_name,
-                                                                                                                                        vinmonopolet_company_name,
-                                                                                                                                        normalized_name_similarity,
-                                                                                                                                        search_name_similarity))
-                    # TODO mark as bad match, and keep in output json for manual de-marking?
-                    continue
-
-                if vegan_company["dev.countries"].isdisjoint(candidate["dev.countries"]):
-                    # If countries do not match, require a very close name match
-                    if close_name_match:
-                        if "usa" in vegan_company["dev.countries"] or "canada" in vegan_company["dev.countries"]:
-                            # Barnivore contains many of these entries, but Vinmonpolet does not, so we skip them in order to simplify manual post-processing
-                            print("Warning: skipping entry for USA or Canada company with country value mismatch: companies '{}' and '{}' ".format(vegan_company_name,
-                                                                                                                                         vinmonopolet_company_name))
-
-                        else:
-                            print("Warning: country mismatch for companies '{}' and '{}'".format(vegan_company_name, vinmonopolet_company_name))
-                            vegan_company["dev.country_mismatch"] = True  # Mark the entry for inspection
-                            possible_matches.append(candidate)
+    return multiprocessing.Pool(processes=num_agents, initializer=init_worker, initargs=(name_tables,)), num_agents
+
+
+def find_possible_company_matches(vegan_companies, wine_companies_at_vinmonopolet, candidate_limit=None, lookup_titles=True, ranker=None,
+                                  cross_country_min_ratio=name_match_min_ratio, category="wine", candidate_log=None):
+    pool, num_agents = create_pool({category: name_table(vegan_companies, wine_companies_at_vinmonopolet)})
+    with pool:
+        job = start_possible_company_matches(pool, num_agents, vegan_companies, wine_companies_at_vinmonopolet, candidate_limit,
+                                             category, cross_country_min_ratio)
+        return finish_possible_company_matches(job, lookup_titles, ranker, candidate_log)
+
+
+def start_possible_company_matches(pool, num_agents, vegan_companies, wine_companies_at_vinmonopolet, candidate_limit=None, category="wine",
+                                   cross_country_min_ratio=name_match_min_ratio):
+    """Queues the name comparisons of one category on pool without waiting, pass the job to finish_possible_company_matches"""
+    # a few ranges per worker, so that a worker with slow names does not hold up the others
+    range_size = -(-len(vegan_companies) // (num_agents * 4)) or 1
+    tasks = [(category, first, min(first + range_size, len(vegan_companies)), candidate_limit, cross_country_min_ratio)
+             for first in range(0, len(vegan_companies), range_size)]
+    run_metrics["counters"]["all_pairs"] += len(vegan_companies) * len(wine_companies_at_vinmonopolet)
+    return {"category": category, "workers": num_agents, "tasks": len(tasks), "range_size": range_size,
+            "vegan_companies": vegan_companies, "wine_companies_at_vinmonopolet": wine_companies_at_vinmonopolet,
+            "start": timer(), "result": pool.map_async(find_possible_matches, tasks, 1)}
+
+
+def finish_possible_company_matches(job, lookup_titles=True, ranker=None, candidate_log=None):
+    """
+    Waits for a job from start_possible_company_matches and selects the best match of each Barnivore company,
+    appending the candidates with their scores and outcome to candidate_log
+    """
+    counters = run_metrics["counters"]
+    ranker = ranker or wines.CandidateRanker()
+    # the ranker may be shared by the jobs of several categories, and keeps counting
+    ranker_scored, ranker_pruned = ranker.scored, ranker.pruned
+
+    def log_candidate(vegan_company, candidate, normalized_name_similarity, search_name_similarity, outcome):
+        if candidate_log is not None:
+            candidate_log.append({"company_id": vegan_company["id"], "produsent": candidate["company_name"],
+                                  "normalized_name_score": int(normalized_name_similarity),
+                                  "search_string_score": int(search_name_similarity), "outcome": outcome})
+    result = job["result"].get()
+    pool_seconds = timer() - job["start"]
+    pair_count = sum(x[1] for x in result)
+    excluded_count = sum(x[2] for x in result)
+    busy_seconds = sum(x[3] for x in result)
+    num_agents = job["workers"]
+    print("Compared {} candidate {} company pairs".format(pair_count, job["category"]))
+    counters["pairs_considered"] += pair_count
+    counters["pairs_excluded_by_country"] += excluded_count
+    run_metrics["pool"].append({"category": job["category"], "workers": num_agents, "tasks": job["tasks"], "range_size": job["range_size"],
+                                "seconds": pool_seconds, "busy_seconds": busy_seconds,
+                                "utilization": busy_seconds / (num_agents * pool_seconds) if pool_seconds else 0.0})
+
+    vegan_companies = job["vegan_companies"]
+    wine_companies_at_vinmonopolet = job["wine_companies_at_vinmonopolet"]
+    name_matches = {}
+    for pairs, _, _, _ in result:
+        for barnivore_position, vinmonopolet_position in pairs:
+            name_matches.setdefault(barnivore_position, []).append(wine_companies_at_vinmonopolet[vinmonopolet_position])
+    filtered_list = [(vegan_companies[x], name_matches[x]) for x in sorted(name_matches)]
+    counters["companies_with_name_matches"] += len(filtered_list)
+    counters["pairs_passed_possible_name_match"] += sum(len(x[1]) for x in filtered_list)
+    selected_matches = []
+
+    for vegan_company, vinmonopolet_companies in filtered_list:
+        vegan_company_name = vegan_company["company_name"]
+        # print("Searching for company '{}' ('{}') at Vinmonopolet...".format(vegan_company_name, vegan_company["dev.search_string"]))
+
+        normalized_name_similarities = wines.ratio_matrix([vegan_company["dev.normalized_name"]],
+                                                          [x["dev.normalized_name"] for x in vinmonopolet_companies])[0]
+        search_name_similarities = wines.ratio_matrix([vegan_company["dev.search_string"]],
+                                                      [x["dev.search_string"] for x in vinmonopolet_companies])[0]
+
+        possible_matches = []
+        similarities = []
+        for candidate, normalized_name_similarity, search_name_similarity in zip(vinmonopolet_companies,
+                                                                                  normalized_name_similarities,
+                                                                                  search_name_similarities):
+            vinmonopolet_company_name = candidate["company_name"]
+            close_name_match = search_name_similarity > 0.9
+
+            if (not close_name_match and normalized_name_similarity < 0.65) or normalized_name_similarity < 0.45:
+                print("Warning: ignoring match between companies '{}' and '{}', listed names vary too much - {:.3f}, {:.3f}".format(vegan_company_name,
+                                                                                                                                    vinmonopolet_company_name,
+                                                                                                                                    normalized_name_similarity,
+                                                                                                                                    search_name_similarity))
+                # TODO mark as bad match, and keep in output json for manual de-marking?
+                counters["rejected_name_spread"] += 1
+                log_candidate(vegan_company, candidate, normalized_name_similarity, search_name_similarity, "rejected_name_spread")
+                continue
+
+            if vegan_company["dev.countries"].isdisjoint(candidate["dev.countries"]):
+                # If countries do not match, require a very close name match
+                if close_name_match:
+                    if "usa" in vegan_company["dev.countries"] or "canada" in vegan_company["dev.countries"]:
+                        # Barnivore contains many of these entries, but Vinmonpolet does not, so we skip them in order to simplify manual post-processing
+                        print("Warning: skipping entry for USA or Canada company with country value mismatch: companies '{}' and '{}' ".format(vegan_company_name,
+                                                                                                                                     vinmonopolet_company_name))
+                        counters["rejected_usa_canada_country_mismatch"] += 1
+                        log_candidate(vegan_company, candidate, normalized_name_similarity, search_name_similarity, "rejected_usa_canada_country_mismatch")
                     else:
-                        print("Warning: ignoring match between companies '{}' and '{}', countries differ".format(vegan_company_name, vinmonopolet_company_name))
+                        print("Warning: country mismatch for companies '{}' and '{}'".format(vegan_company_name, vinmonopolet_company_name))
+                        vegan_company["dev.country_mismatch"] = True  # Mark the entry for inspection
+                        counters["accepted_country_mismatch"] += 1
+                        possible_matches.append(candidate)
+                        similarities.append((normalized_name_similarity, search_name_similarity))
                 else:
-                    possible_matches.append(candidate)
-
-            if len(possible_matches) > 1:
-                print("Multiple possible matches for company '{}' ({}):".format(vegan_company_name, vegan_company["red_yellow_green"]))
-                for candidate in possible_matches:
-                    print("    '{}' ('{}' ≈ '{}')".format(candidate["company_name"],
-                                                          vegan_company["dev.normalized_name"],
-                                                          candidate["dev.normalized_name"]))
-
-                best_candidate = None
-                best_similarity_score = -1
-                for candidate in possible_matches:
-                    similarity_score = wines.name_similarity(vegan_company["dev.normalized_name"], candidate["dev.normalized_name"])
-                    if similarity_score > best_similarity_score:
-                        best_candidate = candidate
-                        best_similarity_score = similarity_score
-                    # todo OR - sort by similarity, and if top two matches are really close in similarity, do a tie break comparision in more detail
-
-                print("Selected '{}' as the most closest match - {:.3f}".format(best_candidate["company_name"], best_similarity_score))
-                vegan_company["products_found_at_vinmonopolet"] = best_candidate["products_found_at_vinmonopolet"]
-                print_possible_match_detail(vegan_company, best_candidate)
-            elif possible_matches:
-                normalized_name_similarity = wines.name_similarity(vegan_company["dev.normalized_name"], possible_matches[0]["dev.normalized_name"])
-                search_name_similarity = wines.name_similarity(vegan_company["dev.search_string"], possible_matches[0]["dev.search_string"])
-                print("Possible match for company '{}': '{}' ({}) - {:.3f}, {:.3f}".format(vegan_company_name,
-                                                                                           possible_matches[0]["company_name"],
-                                                                                           vegan_company["red_yellow_green"],
-                                                                                           normalized_name_similarity,
-                                                                                           search_name_similarity))
-                vegan_company["products_found_at_vinmonopolet"] = possible_matches[0]["products_found_at_vinmonopolet"]
-                print_possible_match_detail(vegan_company, possible_matches[0])
-
-        return [x[0] for x in filtered_list]  # barnivore companies with added data
+                    print("Warning: ignoring match between companies '{}' and '{}', countries differ".format(vegan_company_name, vinmonopolet_company_name))
+                    counters["rejected_country_mismatch"] += 1
+                    log_candidate(vegan_company, candidate, normalized_name_similarity, search_name_similarity, "rejected_country_mismatch")
+            else:
+                possible_matches.append(candidate)
+                similarities.append((normalized_name_similarity, search_name_similarity))
+
+        if len(possible_matches) > 1:
+            print("Multiple possible matches for company '{}' ({}):".format(vegan_company_name, vegan_company["red_yellow_green"]))
+            for candidate in possible_matches:
+                print("    '{}' ('{}' ≈ '{}')".format(candidate["company_name"],
+                                                      vegan_company["dev.normalized_name"],
+                                                      candidate["dev.normalized_name"]))
+
+            position, score, scores = ranker.top_k(vegan_company, possible_matches, similarities)[0]
+            best_candidate = possible_matches[position]
+            print("Selected '{}' as the most closest match - {:.3f} ({})".format(
+                best_candidate["company_name"], score, ", ".join("{} {:.0f}".format(name, value) for name, value in scores.items())))
+            vegan_company["products_found_at_vinmonopolet"] = best_candidate["products_found_at_vinmonopolet"]
+            selected_matches.append((vegan_company, best_candidate))
+        elif possible_matches:
+            normalized_name_similarity, search_name_similarity = similarities[0]
+            print("Possible match for company '{}': '{}' ({}) - {:.3f}, {:.3f}".format(vegan_company_name,
+                                                                                       possible_matches[0]["company_name"],
+                                                                                       vegan_company["red_yellow_green"],
+                                                                                       normalized_name_similarity,
+                                                                                       search_name_similarity))
+            vegan_company["products_found_at_vinmonopolet"] = possible_matches[0]["products_found_at_vinmonopolet"]
+            selected_matches.append((vegan_company, possible_matches[0]))
+
+        for candidate, (normalized_name_similarity, search_name_similarity) in zip(possible_matches, similarities):
+            log_candidate(vegan_company, candidate, normalized_name_similarity, search_name_similarity,
+                          "selected" if candidate is selected_matches[-1][1] else "not_selected")
+
+    counters["selected_matches"] += len(selected_matches)
+    counters["ranker_scored_candidates"] += ranker.scored - ranker_scored
+    counters["ranker_pruned_candidates"] += ranker.pruned - ranker_pruned
+    print_possible_match_details(selected_matches, lookup_titles, job["category"])
+
+    return [x[0] for x in filtered_list]  # barnivore companies with added data
+
+
+def print_possible_match_details(matches, lookup_titles=True, category="wine", max_concurrent_lookups=16):
+    # Look up the website titles concurrently, so one slow site does not stall the whole report
+    if lookup_titles:
+        urls = [vegan_company["url"].strip() for vegan_company, _ in matches]
+        with measure_stage("website_title_lookups_{}".format(category)):
+            titles = http_helper.get_titles(urls, max_concurrent_lookups, run_metrics["http_lookup_seconds"], title_lookup_deadline)
+        for (vegan_company, _), title in zip(matches, titles):
+            vegan_company["dev.site_title"] = title
+    for vegan_company, vinmonopolet_company in matches:
+        print_possible_match_detail(vegan_company, vinmonopolet_company)
 
 
 def print_possible_match_detail(vegan_company, vinmonopolet_company):
     url = vegan_company["url"].strip()
-    print("  {} - \"{}\"".format(url, http_helper.get_title(url)))
+    print("Match details for company '{}':".format(vegan_company["company_name"]))
+    print("  {} - \"{}\"".format(url, vegan_company.get("dev.site_title")))
 
     print("  {}".format(vinmonopolet_company["products_found_at_vinmonopolet"][0]["Vareurl"]))
     print("  {} products found".format(len(vinmonopolet_company["products_found_at_vinmonopolet"])))
 
 
-if __name__ == "__main__":
-    start = timer()
+def fingerprint(*values):
+    return hashlib.sha1(json.dumps(values, ensure_ascii=False, sort_keys=True, default=wines.to_json).encode('utf-8')).hexdigest()
+
+
+def barnivore_fingerprint(company):
+    return fingerprint(company["id"], company.get("updated_on"), company["company_name"], company["country"], company["status"],
+                       company["dev.search_string"], company["dev.normalized_name"])
+
+
+def vinmonopolet_fingerprint(company):
+    return fingerprint(company["company_name"], sorted(x["Varenummer"] for x in company["products_found_at_vinmonopolet"]),
+                       company["dev.search_string"], company["dev.normalized_name"])
+
+
+def matching_settings(candidate_limit=None, ranker=None, cross_country_min_ratio=name_match_min_ratio):
+    """A fingerprint of the settings and code of the matching, matches found with other ones are not carried forward"""
+    sources = []
+    for module_filename in [__file__, wines.__file__]:
+        with open(module_filename, mode='rb') as f:
+            sources.append(hashlib.sha256(f.read()).hexdigest())
+    return fingerprint(sources, candidate_limit, (ranker or wines.CandidateRanker()).weights, cross_country_min_ratio)
+
+
+def load_match_state(filename):
+    if not os.path.exists(filename):
+        return {"settings": None, "barnivore": {}, "vinmonopolet": {}, "matches": {}}
+    with open(filename, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def save_match_state(filename, vegan_companies, wine_companies_at_vinmonopolet, matched_companies, settings):
+    matches = {}
+    for company in matched_companies:
+        if company.get("products_found_at_vinmonopolet"):
+            matches[str(company["id"])] = {"company": company["products_found_at_vinmonopolet"][0]["Produsent"],
+                                           "country_mismatch": company.get("dev.country_mismatch", False),
+                                           "site_title": company.get("dev.site_title")}
+    state = {"settings": settings,
+             "barnivore": {str(x["id"]): barnivore_fingerprint(x) for x in vegan_companies},
+             "vinmonopolet": {x["company_name"]: vinmonopolet_fingerprint(x) for x in wine_companies_at_vinmonopolet},
+             "matches": matches}
+    with open(filename, mode='w', encoding='utf-8') as f:
+        json.dump(state, f, ensure_ascii=False)
+
+
+def find_possible_company_matches_incremental(vegan_companies, wine_companies_at_vinmonopolet, state, candidate_limit=None, ranker=None,
+                                              cross_country_min_ratio=name_match_min_ratio, category="wine", candidate_log=None):
+    """
+    Like find_possible_company_matches, but only rescores the Barnivore companies that changed or may match changed
+    Vinmonopolet companies, the other matches are carried forward from state.
+    Returns the matched companies and the ids of the rescored ones, only these are in candidate_log
+    """
+    old_matches = state["matches"]
+    changed_vegan_companies = [x for x in vegan_companies if state["barnivore"].get(str(x["id"])) != barnivore_fingerprint(x)]
+    current_ids = {str(x["id"]) for x in vegan_companies}
+    removed_vegan_company_ids = [x for x in state["barnivore"] if x not in current_ids]
+
+    changed_vinmonopolet_companies = [x for x in wine_companies_at_vinmonopolet
+                                      if state["vinmonopolet"].get(x["company_name"]) != vinmonopolet_fingerprint(x)]
+    current_names = {x["company_name"] for x in wine_companies_at_vinmonopolet}
+    removed_vinmonopolet_companies = [x for x in state["vinmonopolet"] if x not in current_names]
+
+    print("Barnivore: {} new or changed, {} removed companies".format(len(changed_vegan_companies), len(removed_vegan_company_ids)))
+    for company in changed_vegan_companies:
+        print("    {} '{}' ({})".format("changed" if str(company["id"]) in state["barnivore"] else "new", company["company_name"], company["id"]))
+    for company_id in removed_vegan_company_ids:
+        print("    removed id {}".format(company_id))
+    print("Vinmonopolet: {} new or changed, {} removed companies".format(len(changed_vinmonopolet_companies), len(removed_vinmonopolet_companies)))
+    for company in changed_vinmonopolet_companies:
+        print("    {} '{}'".format("changed" if company["company_name"] in state["vinmonopolet"] else "new", company["company_name"]))
+    for name in removed_vinmonopolet_companies:
+        print("    removed '{}'".format(name))
+
+    # unchanged Barnivore companies must be rescored if their match changed or went away, or if a changed company may match them
+    changed_vinmonopolet_names = {x["company_name"] for x in changed_vinmonopolet_companies} | set(removed_vinmonopolet_companies)
+    changed_vegan_company_ids = {x["id"] for x in changed_vegan_companies}
+    changed_index = wines.NgramIndex(changed_vinmonopolet_companies)
+    rescored_companies = list(changed_vegan_companies)
+    carried_forward_companies = []
+    if state.get("settings") != matching_settings(candidate_limit, ranker, cross_country_min_ratio):
+        print("The matching settings or code changed since the state was saved, rescoring all companies")
+        rescored_companies = list(vegan_companies)
+    else:
+        for company in vegan_companies:
+            if company["id"] in changed_vegan_company_ids:
+                continue
+            old_match = old_matches.get(str(company["id"]))
+            if old_match and old_match["company"] in changed_vinmonopolet_names:
+                rescored_companies.append(company)
+                continue
+            candidates = [changed_vinmonopolet_companies[i] for i in changed_index.candidates(company["dev.search_string"], limit=candidate_limit)]
+            if candidates and possible_name_matches(candidates, company).any():
+                rescored_companies.append(company)
+            elif old_match:
+                carried_forward_companies.append((company, old_match))
+
+    print("Rescoring {} Barnivore companies, carrying forward {} matches".format(len(rescored_companies), len(carried_forward_companies)))
+    matched_companies = find_possible_company_matches(rescored_companies, wine_companies_at_vinmonopolet, candidate_limit,
+                                                      ranker=ranker, cross_country_min_ratio=cross_country_min_ratio,
+                                                      category=category, candidate_log=candidate_log) if rescored_companies else []
+
+    vinmonopolet_companies_by_name = {x["company_name"]: x for x in wine_companies_at_vinmonopolet}
+    for company, old_match in carried_forward_companies:
+        company["products_found_at_vinmonopolet"] = vinmonopolet_companies_by_name[old_match["company"]]["products_found_at_vinmonopolet"]
+        if old_match["country_mismatch"]:
+            company["dev.country_mismatch"] = True
+        if old_match.get("site_title"):
+            company["dev.site_title"] = old_match["site_title"]
+        matched_companies.append(company)
+    # in the order of a full run
+    positions = {x["id"]: i for i, x in enumerate(vegan_companies)}
+    matched_companies.sort(key=lambda x: positions[x["id"]])
+
+    for company in matched_companies:
+        old_match = old_matches.get(str(company["id"]))
+        products = company.get("products_found_at_vinmonopolet")
+        new_match = products[0]["Produsent"] if products else None
+        if not old_match and new_match:
+            print("New match for company '{}': '{}'".format(company["company_name"], new_match))
+        elif old_match and old_match["company"] != new_match:
+            print("Changed match for company '{}': '{}' -> '{}'".format(company["company_name"], old_match["company"], new_match))
+    matched_ids = {str(x["id"]) for x in matched_companies if x.get("products_found_at_vinmonopolet")}
+    for company_id, old_match in old_matches.items():
+        if company_id not in matched_ids:
+            print("Lost match for company id {}: '{}'".format(company_id, old_match["company"]))
+
+    return matched_companies, {x["id"] for x in rescored_companies}
 
-    wine_companies_at_vinmonopolet = wines.load_wine_companies_from_vinmonopolet('produkter.csv')
-    wine_companies_from_barnivore = wines.load_companies_from_barnivore('wine.json')
-    print("Using {} wine companies at Vinmonopolet, and {} listed in Barnivore".format(
-        len(wine_companies_at_vinmonopolet), len(wine_companies_from_barnivore)))
 
-    stopwords = wines.create_stopword_list(wine_companies_from_barnivore, wine_companies_at_vinmonopolet)
-    wine_companies_at_vinmonopolet = wines.add_normalized_names(wine_companies_at_vinmonopolet, stopwords)
-    wine_companies_from_barnivore = wines.add_normalized_names(wine_companies_from_barnivore, stopwords)
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Find vegan wine companies at Vinmonopolet")
+    parser.add_argument("--categories", default="wine",
+                        help="comma separated list of the categories to match, of wine, beer and spirits (default: %(default)s). "
+                             "The Vinmonopolet export is only parsed once, and the categories share one worker pool")
+    parser.add_argument("--candidate-limit", type=int, default=None,
+                        help="max number of Vinmonopolet candidates compared per Barnivore company (default: all sharing an n-gram)")
+    parser.add_argument("--cross-country-min-ratio", type=int, default=name_match_min_ratio,
+                        help="the search string ratio required to match companies without a country in common (default: %(default)s, "
+                             "the same as within a country). USA and Canada companies are only matched within their country. "
+                             "Use 101 to only match within countries")
+    parser.add_argument("--score-weights", metavar="NAME=WEIGHT,...",
+                        help="weights of the composite score used to pick the best of several matching companies, of "
+                             + ", ".join("{}={}".format(*x) for x in wines.default_score_weights.items()) + " (the default)")
+    parser.add_argument("--check-recall", action="store_true",
+                        help="report the candidate index recall against an all-pairs comparison")
+    parser.add_argument("--http-cache", metavar="DIR",
+                        help="cache fetched web pages in this directory, revalidating them after --http-cache-ttl seconds")
+    parser.add_argument("--http-cache-ttl", type=int, default=24 * 3600)
+    parser.add_argument("--snapshot-dir", default=".snapshots",
+                        help="where to keep the parsed and normalized datasets between runs (default: %(default)s)")
+    parser.add_argument("--no-snapshot", action="store_true", help="always parse the input files")
+    parser.add_argument("--incremental", metavar="STATE_FILE",
+                        help="only rescore companies that changed since the run that saved STATE_FILE, and update it")
+    parser.add_argument("--output-format", choices=["json", "jsonl"], default="json",
+                        help="json writes pretty-printed result files with every product in full, jsonl writes one line per company "
+                             "and refers to a single copy of each product (default: %(default)s)")
+    parser.add_argument("--store", default=match_store.default_store_filename,
+                        help="the SQLite file to keep the companies, products, candidate matches and review decisions in (default: %(default)s), "
+                             "see match_store.py. Use --store '' to skip it")
+    parser.add_argument("--metrics", default=metrics_output_filename,
+                        help="where to write the JSON report of time, memory and counters per stage (default: %(default)s)")
+    parser.add_argument("--trace-memory", action="store_true",
+                        help="also report the peak memory allocated by each stage in this process, this makes the run a few times slower")
+    args = parser.parse_args()
+
+    categories = args.categories.split(",")
+    if any(x not in wines.barnivore_filenames for x in categories):
+        parser.error("unknown category in --categories {}, use {}".format(args.categories, ",".join(wines.barnivore_filenames)))
+    if args.incremental and len(categories) > 1:
+        parser.error("--incremental matches a single category")
+    try:
+        weights = dict((name, float(weight)) for name, weight in (x.split("=") for x in args.score_weights.split(","))) if args.score_weights else None
+        ranker = wines.CandidateRanker(weights)
+    except ValueError as e:
+        parser.error("invalid --score-weights {}: {}".format(args.score_weights, e))
+
+    if args.trace_memory:
+        tracemalloc.start()
+    if args.http_cache:
+        http_helper.enable_cache(args.http_cache, ttl=args.http_cache_ttl)
 
-    vegan_companies_at_vinmonopolet = find_possible_company_matches(wine_companies_from_barnivore, wine_companies_at_vinmonopolet)
+    start = timer()
 
-    write_result_file(vegan_companies_at_vinmonopolet, vegan_friendly_output_filename, some_vegan_products_output_filename)
+    with measure_stage("load_datasets"):
+        datasets_by_category = wines.load_prepared_category_datasets(
+            'produkter.csv', {x: wines.barnivore_filenames[x] for x in categories}, None if args.no_snapshot else args.snapshot_dir)
+    for category, (companies_at_vinmonopolet, companies_from_barnivore, _) in datasets_by_category.items():
+        print("Using {} {} companies at Vinmonopolet, and {} listed in Barnivore".format(
+            len(companies_at_vinmonopolet), category, len(companies_from_barnivore)))
+        run_metrics["counters"]["vinmonopolet_companies"] += len(companies_at_vinmonopolet)
+        run_metrics["counters"]["barnivore_companies"] += len(companies_from_barnivore)
+
+    if args.check_recall:
+        with measure_stage("check_recall"):
+            for companies_at_vinmonopolet, companies_from_barnivore, _ in datasets_by_category.values():
+                report_candidate_recall(companies_from_barnivore, companies_at_vinmonopolet,
+                                        wines.NgramIndex(companies_at_vinmonopolet), args.candidate_limit)
+
+    candidate_logs = {category: [] for category in categories}
+    rescored_company_ids = None  # all of them
+    with measure_stage("matching"):
+        if args.incremental:
+            wine_companies_at_vinmonopolet, wine_companies_from_barnivore, _ = datasets_by_category[categories[0]]
+            state = load_match_state(args.incremental)
+            matched_companies, rescored_company_ids = find_possible_company_matches_incremental(
+                wine_companies_from_barnivore, wine_companies_at_vinmonopolet, state, args.candidate_limit, ranker, args.cross_country_min_ratio,
+                categories[0], candidate_logs[categories[0]])
+            vegan_companies_by_category = {categories[0]: matched_companies}
+            save_match_state(args.incremental, wine_companies_from_barnivore, wine_companies_at_vinmonopolet,
+                             vegan_companies_by_category[categories[0]], matching_settings(args.candidate_limit, ranker, args.cross_country_min_ratio))
+        else:
+            # one pool for all the categories, so the workers are kept busy until the last category is done
+            pool, num_agents = create_pool({category: name_table(companies_from_barnivore, companies_at_vinmonopolet)
+                                            for category, (companies_at_vinmonopolet, companies_from_barnivore, _) in datasets_by_category.items()})
+            with pool:
+                jobs = [start_possible_company_matches(pool, num_agents, companies_from_barnivore, companies_at_vinmonopolet,
+                                                       args.candidate_limit, category, args.cross_country_min_ratio)
+                        for category, (companies_at_vinmonopolet, companies_from_barnivore, _) in datasets_by_category.items()]
+                vegan_companies_by_category = {job["category"]: finish_possible_company_matches(job, ranker=ranker, candidate_log=candidate_logs[job["category"]])
+                                               for job in jobs}
+
+    with measure_stage("write_result_file"):
+        for category, vegan_companies_at_vinmonopolet in vegan_companies_by_category.items():
+            write_result_file(vegan_companies_at_vinmonopolet, *output_filenames(category, args.output_format), category, args.output_format)
+
+    if args.store:
+        with measure_stage("write_store"):
+            store = match_store.open_store(args.store)
+            for category, vegan_companies_at_vinmonopolet in vegan_companies_by_category.items():
+                match_store.write_run(store, category, datasets_by_category[category][1], vegan_companies_at_vinmonopolet, candidate_logs[category],
+                                      rescored_company_ids)
+            store.close()
+        print("Stored the matches in {}".format(args.store))
 
     end = timer()
+    run_metrics["stages"]["total"] = {"seconds": end - start, "max_rss_mb": max_rss_mb()}
+    write_metrics_file(args.metrics)
     print("Total time usage: {}s".format(int(end - start + 0.5)))
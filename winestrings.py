@@ -4,52 +4,60 @@
 import unicodedata
 import string
 from difflib import SequenceMatcher
-from collections import Counter
+from collections import Counter, defaultdict
 import json
+import math
+import re
 import csv
 import sys
+import os
+import pickle
+import hashlib
+from functools import lru_cache
 
 
 def normalize_name(company_name):
-    return remove_diacritics(company_name).strip().lower().replace(".", " ").replace(",", "").replace("-", " ").replace("  ", " ")
+    return default_normalizer.normalize(company_name)
+
+
+common_abbreviations = {
+    # poor man's abbreviation
+    "domaine": "dom.",
+    "domini": "dom.",
+    "dominio": "dom.",
+    "chateau": "ch.",
+    "agricola": "agr.",
+    "weingut": "weing.",
+    "weingt": "weing.",
+    "bodegas": "bod.",
+    "cantine": "cant.",
+    "cantina": "cant.",
+    "tenuta": "ten.",
+    "vinicole": "vin.",
+    "saint": "st.",
+    "estate": "est.",
+    "vigneron": "vign.",
+    "castello": "cast.",
+    "fattoria": "fatt.",
+    "distillery": "dist.",
+    "distilleria": "dist.",
+    "fratelli": "f.lli",
+    "doctor": "dr.",
+    "poderi": "pod.",
+    "marques": "marq.",
+    "marchesi": "march.",
+    "azienda agricola": "az.agr.",
+    "brothers": "bros.",
+    "sainte": "ste.",
+    "societa' agricola": "soc.agr.",
+    "societa agricola": "soc.agr.",
+    "mount": "mt.",
+    "gebruder": "gebr.",
+    "champagne": "champ."
+}
 
 
 def get_common_abbreviations():
-    common_abbreviations = {
-        # poor man's abbreviation
-        "domaine": "dom.",
-        "domini": "dom.",
-        "dominio": "dom.",
-        "chateau": "ch.",
-        "agricola": "agr.",
-        "weingut": "weing.",
-        "weingt": "weing.",
-        "bodegas": "bod.",
-        "cantine": "cant.",
-        "cantina": "cant.",
-        "tenuta": "ten.",
-        "vinicole": "vin.",
-        "saint": "st.",
-        "estate": "est.",
-        "vigneron": "vign.",
-        "castello": "cast.",
-        "fattoria": "fatt.",
-        "distillery": "dist.",
-        "distilleria": "dist.",
-        "fratelli": "f.lli",
-        "doctor": "dr.",
-        "poderi": "pod.",
-        "marques": "marq.",
-        "marchesi": "march.",
-        "azienda agricola": "az.agr.",
-        "brothers": "bros.",
-        "sainte": "ste.",
-        "societa' agricola": "soc.agr.",
-        "societa agricola": "soc.agr.",
-        "mount": "mt.",
-        "gebruder": "gebr.",
-        "champagne": "champ."
-    }
     return common_abbreviations
 
 
@@ -62,128 +70,421 @@ def replace_abbreviations(word):
         return word
 
 
+# The canonical country index: (code, name in Vinmonopolet's Land column in lower case, names used by Barnivore).
+# The codes are ISO 3166-1, or ISO 3166-2 for the parts of a country that are listed as countries of their own.
+countries = [
+    ("AR", "argentina", ["argentina"]),
+    ("AT", "østerrike", ["austria"]),
+    ("AU", "australia", ["australia"]),
+    ("AU-TAS", "tasmania", ["tasmania"]),
+    ("BB", "barbados", ["barbados"]),
+    ("BE", "belgia", ["belgium"]),
+    ("BG", "bulgaria", ["bulgaria"]),
+    ("BM", "bermuda", ["bermuda"]),
+    ("BR", "brasil", ["brazil"]),
+    ("BS", "bahamas", ["bahamas"]),
+    ("BZ", "belize", ["belize"]),
+    ("CA", "canada", ["canada"]),
+    ("CH", "sveits", ["switzerland"]),
+    ("CL", "chile", ["chile"]),
+    ("CN", "kina", ["china"]),
+    ("CO", "colombia", ["colombia", "columbia"]),
+    ("CR", "costa rica", ["costa rica"]),
+    ("CU", "cuba", ["cuba"]),
+    ("CY", "kypros", ["cyprus"]),
+    ("CZ", "tsjekkia", ["czech republic"]),
+    ("DE", "tyskland", ["germany"]),
+    ("DK", "danmark", ["denmark"]),
+    ("DO", "den dominikanske republikk", ["dominican republic"]),
+    ("EE", "estland", ["estonia"]),
+    ("ES", "spania", ["spain"]),
+    ("ET", "etiopia", ["ethiopia"]),
+    ("FI", "finland", ["finland"]),
+    ("FJ", "fiji", ["fiji"]),
+    ("FR", "frankrike", ["france"]),
+    ("GB", "storbritannia", ["united kingdom"]),
+    ("GB-ENG", "england", ["england", "enlgland"]),
+    ("GB-NIR", "nord-irland", ["northern ireland"]),
+    ("GB-SCT", "scotland", ["scotland"]),
+    ("GB-WLS", "wales", ["wales"]),
+    ("GE", "georgia", ["georgia"]),
+    ("GN", "guinea", ["french guinea"]),
+    ("GR", "hellas", ["greece"]),
+    ("GT", "guatemala", ["guatemala"]),
+    ("HK", "hong kong", ["hong kong"]),
+    ("HR", "kroatia", ["croatia"]),
+    ("HU", "ungarn", ["hungary"]),
+    ("ID", "indonesia", ["indonesia"]),
+    ("IE", "irland", ["ireland"]),
+    ("IL", "israel", ["israel"]),
+    ("IM", "man", ["isle of man"]),
+    ("IN", "india", ["india"]),
+    ("IS", "island", ["iceland"]),
+    ("IT", "italia", ["italy"]),
+    ("JE", "jersey", ["jersey"]),
+    ("JM", "jamaica", ["jamaica"]),
+    ("JP", "japan", ["japan"]),
+    ("KE", "kenya", ["kenya"]),
+    ("KH", "kambodsja", ["cambodia"]),
+    ("KR", "sør-korea", ["south korea"]),
+    ("KY", "caymanøyene", ["cayman islands"]),
+    ("LB", "libanon", ["lebanon"]),
+    ("LT", "litauen", ["lithuania"]),
+    ("LU", "luxemburg", ["luxembourg"]),
+    ("LV", "latvia", ["latvia"]),
+    ("ME", "montenegro", ["montenegro"]),
+    ("MT", "malta", ["malta"]),
+    ("MX", "mexico", ["mexico"]),
+    ("MY", "malaysia", ["malaysia"]),
+    ("NA", "namibia", ["namibia"]),
+    ("NI", "nicaragua", ["nicaragua"]),
+    ("NL", "nederland", ["netherlands", "the netherlands", "holland"]),
+    ("NO", "norge", ["norway"]),
+    ("NZ", "new zealand", ["new zealand"]),
+    ("PE", "peru", ["peru"]),
+    ("PH", "filipinene", ["philippines"]),
+    ("PL", "polen", ["poland"]),
+    ("PR", "puerto rico", ["puerto rico"]),
+    ("PS", "palestina", ["palestine"]),
+    ("PT", "portugal", ["portugal"]),
+    ("RO", "romania", ["romania"]),
+    ("RS", "serbia", ["serbia"]),
+    ("RU", "russland", ["russia"]),
+    ("SE", "sverige", ["sweden"]),
+    ("SG", "singapore", ["singapore"]),
+    ("SI", "slovenia", ["slovenia"]),
+    ("SK", "slovakia", ["slovakia", "slovak republic"]),
+    ("TC", "turks- og caicosøyene", ["turks & caicos islands"]),
+    ("TH", "thailand", ["thailand"]),
+    ("TR", "turkia", ["turkey"]),
+    ("TT", "trinidad og tobago", ["republic of trinidad and tobago"]),
+    ("TW", "taiwan", ["taiwan"]),
+    ("UA", "ukraina", ["ukraine"]),
+    ("US", "usa", ["usa"]),
+    ("UY", "uruguay", ["uruguay"]),
+    ("VE", "venezuela", ["venezuela"]),
+    ("ZA", "sør-afrika", ["south africa"]),
+]
+
+# Barnivore's country names translated to Vinmonopolet's
+country_translations = {name: norwegian_name for _, norwegian_name, names in countries for name in names}
+# Both kinds of names to country code
+country_codes = {name: code for code, norwegian_name, names in countries for name in [norwegian_name] + names}
+unknown_countries = set()
+
+
 def translate_country_name(country, company_id):
     if not country:
         return country
 
-    country_dict = {
-        # poor man's translation to Norwegian
-        "italy": "italia",
-        "france": "frankrike",
-        "germany": "tyskland",
-        "spain": "spania",
-        "austria": "østerrike",
-        "norway": "norge",
-        "sweden": "sverige",
-        "denmark": "danmark",
-        "netherlands": "nederland",
-        "ireland": "irland",
-        "greece": "hellas",
-        "hungary": "ungarn",
-        "croatia": "kroatia",
-        "finland": "finland",
-        "slovakia": "slovakia",
-        "poland": "polen",
-        "south africa": "sør-afrika",
-        "usa": "usa",
-        "england": "england",
-        "chile": "chile",
-        "united kingdom": "storbritannia",
-        "argentina": "argentina",
-        "israel": "israel",
-        "mexico": "mexico",
-        "luxembourg": "luxemburg",
-        "switzerland": "sveits",
-        "lebanon": "libanon",
-        "malta": "malta",
-        "slovenia": "slovenia",
-        "montenegro": "montenegro",
-        "tasmania": "tasmania",
-        "cyprus": "kypros",
-        "turkey": "turkia",
-        "venezuela": "venezuela",
-        "scotland": "scotland",
-        "georgia": "georgia",
-        "thailand": "thailand",
-        "the netherlands": "nederland",
-        "new zealand": "new zealand",
-        "portugal": "portugal",
-        "uruguay": "uruguay",
-        "brazil": "brasil",
-        "japan": "japan",
-        "australia": "australia",
-        "canada": "canada",
-        'belgium': "belgia",
-        'belize': "belize",
-        'bermuda': "bermuda",
-        'bulgaria': "bulgaria",
-        'cayman islands': "caymanøyene",
-        'china': "kina",
-        'columbia': "kolombia",
-        'costa rica': "costa rica",
-        'czech republic': "tsjekkia",
-        'dominican republic': 'den dominikanske republikk',
-        'estonia': "estland",
-        'ethiopia': "etiopia",
-        'fiji': "fiji",
-        'french guinea': "guinea",
-        'guatemala': "guatemala",
-        'hong kong': "hong kong",
-        'iceland': "island",
-        'india': "india",
-        'isle of man': "man",
-        'jamaica': "jamaica",
-        'kenya': "kenya",
-        'latvia': "latvia",
-        'lithuania': "litauen",
-        'malaysia': "malaysia",
-        'namibia': "namibia",
-        'northern ireland': "nord-irland",
-        'palestine': "palestina",
-        'philippines': "filipinene",
-        'puerto rico': "puerto rico",
-        'romania': "romania",
-        'russia': "russland",
-        'singapore': "singapore",
-        'slovak republic': "slovakia",
-        'south korea': "sør-korea",
-        'taiwan': "taiwan",
-        "peru": "peru",
-        "republic of trinidad and tobago": "trinidad og tobago",
-        "nicaragua": "nicaragua",
-        "cuba": "cuba",
-        "barbados": "barbados",
-        "ukraine": "ukraina",
-        "serbia": "serbia",
-        "holland": "nederland",
-        "wales": "wales",
-        "indonesia": "indonesia"
-    }
-
     try:
-        return country_dict[country.strip()]
+        return country_translations[country.strip()]
     except KeyError:
-        print("KeyError for country '{}' (company id {})".format(country, company_id))
+        if country not in unknown_countries:
+            unknown_countries.add(country)
+            print("Unknown country '{}' (company id {}), add it to winestrings.countries".format(country, company_id))
         return country
 
 
+def country_code(country):
+    """The code of a country name from Vinmonopolet or Barnivore, in any case. Unknown names are their own code"""
+    country = country.lower().strip()
+    return country_codes.get(country, country)
+
+
+# string.printable is all of ASCII except these control characters
+non_printable_ascii = bytes(x for x in range(128) if chr(x) not in string.printable)
+
+
 def remove_diacritics(s):
-    return ''.join(x for x in unicodedata.normalize('NFKD', s) if x in string.printable)
+    return ascii_bytes(s).decode('ascii')
+
+
+def ascii_bytes(s):
+    return unicodedata.normalize('NFKD', s).encode('ascii', 'ignore').translate(None, non_printable_ascii)
+
+
+class NameNormalizer:
+    """Memoized company name normalization, so each name is normalized only once"""
+    # replaces "." and "-" with spaces, "," is deleted
+    punctuation = bytes.maketrans(b".-", b"  ")
+
+    def __init__(self, cache_size=None):
+        self.normalize = lru_cache(maxsize=cache_size)(self._normalize)
+        self.abbreviated = lru_cache(maxsize=cache_size)(self._abbreviated)
+        self.tokens = lru_cache(maxsize=cache_size)(self._tokens)
+
+    def _normalize(self, name):
+        # the same steps as remove_diacritics(name).strip().lower() followed by the replacements, done on ascii bytes
+        normalized = ascii_bytes(name).strip().lower().translate(self.punctuation, b",").replace(b"  ", b" ")
+        return sys.intern(normalized.decode('ascii'))
+
+    def _abbreviated(self, name):
+        # the name used for dev.normalized_name and the dupe finder
+        return self.normalize(replace_abbreviations(name))
+
+    def _tokens(self, name):
+        return tuple(sys.intern(x) for x in self.normalize(name).split(" "))
+
+    def cache_clear(self):
+        self.normalize.cache_clear()
+        self.abbreviated.cache_clear()
+        self.tokens.cache_clear()
+
+
+default_normalizer = NameNormalizer()
+
+
+def suffix_automaton(text):
+    """The suffix automaton of text, as lists of transitions, suffix links and lengths per state"""
+    transitions = [{}]
+    links = [-1]
+    lengths = [0]
+    last = 0
+    for character in text:
+        state = len(lengths)
+        transitions.append({})
+        links.append(0)
+        lengths.append(lengths[last] + 1)
+        previous = last
+        while previous != -1 and character not in transitions[previous]:
+            transitions[previous][character] = state
+            previous = links[previous]
+        if previous != -1:
+            next_state = transitions[previous][character]
+            if lengths[previous] + 1 == lengths[next_state]:
+                links[state] = next_state
+            else:
+                clone = len(lengths)
+                transitions.append(dict(transitions[next_state]))
+                links.append(links[next_state])
+                lengths.append(lengths[previous] + 1)
+                while previous != -1 and transitions[previous].get(character) == next_state:
+                    transitions[previous][character] = clone
+                    previous = links[previous]
+                links[next_state] = clone
+                links[state] = clone
+        last = state
+    return transitions, links, lengths
+
+
+def longest_common_substring(automaton, text):
+    transitions, links, lengths = automaton
+    state = 0
+    length = 0
+    longest = 0
+    for character in text:
+        while state and character not in transitions[state]:
+            state = links[state]
+            length = lengths[state]
+        if character in transitions[state]:
+            state = transitions[state][character]
+            length += 1
+            if length > longest:
+                longest = length
+        else:
+            length = 0
+    return longest
+
+
+# SequenceMatcher ignores popular characters of its second string from this length on, see lcs_many
+autojunk_length = 200
 
 
 def lcs(cleanString1, cleanString2):
-    matcher = SequenceMatcher(None, cleanString1, cleanString2)
-    match = matcher.find_longest_match(0, len(cleanString1), 0, len(cleanString2))
-    return match.size
+    return lcs_many(cleanString2, [cleanString1])[0]
+
+
+def lcs_many(name, other_names):
+    """Returns [lcs(other_name, name) for other_name in other_names], with name preprocessed once into a suffix automaton"""
+    # find_longest_match skips popular characters of long second strings, so those keep using it to get the same lengths
+    if len(name) >= autojunk_length:
+        matcher = SequenceMatcher(None)
+        matcher.set_seq2(name)
+        lengths = []
+        for other_name in other_names:
+            matcher.set_seq1(other_name)
+            lengths.append(matcher.find_longest_match(0, len(other_name), 0, len(name)).size)
+        return lengths
+    automaton = suffix_automaton(name)
+    return [longest_common_substring(automaton, other_name) for other_name in other_names]
 
 
 from fuzzywuzzy import fuzz
+from fuzzywuzzy import utils as fuzz_utils
+import numpy as np
 
 
 def name_similarity(cleanString1, cleanString2):
     return fuzz.token_sort_ratio(cleanString1, cleanString2)
 
 
+@lru_cache(maxsize=None)
+def prepare_for_ratio(name):
+    # the pre-processing fuzz.token_sort_ratio does on each call, done once per name instead
+    tokens = fuzz_utils.full_process(name, force_ascii=True).split()
+    return " ".join(sorted(tokens)).strip()
+
+
+def ratio_upper_bound(name, other_name, counts=None, other_counts=None):
+    """An upper bound on name_similarity from the lengths and shared characters, like SequenceMatcher.quick_ratio"""
+    length_sum = len(name) + len(other_name)
+    if not length_sum:
+        return 100
+    counts = Counter(name) if counts is None else counts
+    other_counts = Counter(other_name) if other_counts is None else other_counts
+    shared = sum((counts & other_counts).values())
+    return fuzz_utils.intr(200 * shared / length_sum)
+
+
+def ratio_matrix(names, other_names, min_ratio=None, prepared=False):
+    """Returns a matrix of name_similarity(names[i], other_names[j]), with 0 where ratio_upper_bound is below min_ratio"""
+    # with prepared, names and other_names are already the output of prepare_for_ratio
+    prepared_names = names if prepared else [prepare_for_ratio(x) for x in names]
+    name_counts = [Counter(x) for x in prepared_names] if min_ratio else None
+    ratios = np.zeros((len(names), len(other_names)), dtype=np.int16)
+    # the matcher keeps its index of other_names[j] for the whole column, so put the longer list in names
+    matcher = fuzz.SequenceMatcher(None)
+    for j, other_name in enumerate(other_names):
+        prepared_other_name = other_name if prepared else prepare_for_ratio(other_name)
+        other_counts = Counter(prepared_other_name) if min_ratio else None
+        matcher.set_seq2(prepared_other_name)
+        for i, prepared_name in enumerate(prepared_names):
+            if prepared_name == prepared_other_name:
+                ratios[i, j] = 100
+            elif prepared_name and prepared_other_name:
+                if min_ratio and ratio_upper_bound(prepared_name, prepared_other_name, name_counts[i], other_counts) < min_ratio:
+                    continue
+                matcher.set_seq1(prepared_name)
+                ratios[i, j] = fuzz_utils.intr(100 * matcher.ratio())
+    return ratios
+
+
+def lcs_matrix(names, other_names):
+    """Returns a matrix where element [i, j] equals lcs(names[i], other_names[j])"""
+    lengths = np.zeros((len(names), len(other_names)), dtype=np.int16)
+    for j, other_name in enumerate(other_names):
+        lengths[:, j] = lcs_many(other_name, names)
+    return lengths
+
+
+# The weight of each name score in the composite score of CandidateRanker
+default_score_weights = {"normalized_name": 0.5, "search_string": 0.3, "lcs": 0.1, "token_overlap": 0.1}
+
+
+class CandidateRanker:
+    """Picks the k best candidates for a company by a weighted sum of name scores, skipping those whose upper bound falls short"""
+
+    def __init__(self, weights=None, k=1, min_score=0):
+        self.weights = dict(default_score_weights if weights is None else weights)
+        unknown = set(self.weights) - set(default_score_weights)
+        if unknown:
+            raise ValueError("Unknown score weights {}, use {}".format(sorted(unknown), list(default_score_weights)))
+        negative = sorted(name for name, weight in self.weights.items() if weight < 0)
+        if negative:
+            # the pruning needs weight * upper bound to be an upper bound of each weighted score
+            raise ValueError("Negative score weights {}".format(negative))
+        self.k = k
+        self.min_score = min_score
+        self.scored = 0
+        self.pruned = 0
+
+    @staticmethod
+    def names(company):
+        search_string = company["dev.search_string"]
+        return (prepare_for_ratio(company["dev.normalized_name"]), prepare_for_ratio(search_string), search_string)
+
+    def upper_bounds(self, names, other_names, ratios=None):
+        # ratios are the exact (normalized_name, search_string) ratios, if already known
+        normalized_name, prepared_search_string, search_string = names
+        other_normalized_name, other_prepared_search_string, other_search_string = other_names
+        shared = sum((Counter(search_string) & Counter(other_search_string)).values())
+        shortest = min(len(search_string), len(other_search_string))
+        tokens = set(search_string.split())
+        other_tokens = set(other_search_string.split())
+        if ratios is None:
+            ratios = (ratio_upper_bound(normalized_name, other_normalized_name),
+                      ratio_upper_bound(prepared_search_string, other_prepared_search_string))
+        return {"normalized_name": int(ratios[0]),
+                "search_string": int(ratios[1]),
+                "lcs": 100 * min(shared, shortest) / shortest if shortest else 0,
+                "token_overlap": 100 * len(tokens & other_tokens) / len(tokens | other_tokens) if tokens or other_tokens else 0}
+
+    def score(self, scores):
+        return sum(weight * scores[name] for name, weight in self.weights.items())
+
+    def top_k(self, company, candidates, ratios=None):
+        """
+        Returns (position in candidates, composite score, name scores) for the k best candidates, best first.
+        ratios are the (normalized_name, search_string) ratios of each candidate, if the caller has computed them
+        """
+        names = self.names(company)
+        bounded = []
+        for position, candidate in enumerate(candidates):
+            other_names = self.names(candidate)
+            scores = self.upper_bounds(names, other_names, None if ratios is None else ratios[position])
+            bounded.append((self.score(scores), position, other_names, scores))
+        # the most promising candidates first, so the k-th best score rises quickly and prunes the rest
+        bounded.sort(key=lambda x: (-x[0], x[1]))
+
+        best = []
+        for bound, position, other_names, scores in bounded:
+            kth_best = best[self.k - 1][0] if len(best) >= self.k else None
+            if bound < self.min_score or (kth_best is not None and bound < kth_best):
+                self.pruned += 1
+                continue
+            self.scored += 1
+            exact = dict(scores)
+            if ratios is None:
+                exact["normalized_name"] = name_similarity(company["dev.normalized_name"], candidates[position]["dev.normalized_name"])
+                exact["search_string"] = name_similarity(names[2], other_names[2])
+            exact["lcs"] = 100 * lcs(names[2], other_names[2]) / min(len(names[2]), len(other_names[2])) if names[2] and other_names[2] else 0
+            score = self.score(exact)
+            if score < self.min_score:
+                continue
+            best.append((score, position, exact))
+            best.sort(key=lambda x: (-x[0], -x[2]["normalized_name"], -x[2]["search_string"], x[1]))
+            del best[self.k:]
+
+        return [(position, score, exact) for score, position, exact in best]
+
+
+def ngrams(text, n=4):
+    return {text[i:i + n] for i in range(len(text) - n + 1)}
+
+
+class NgramIndex:
+    """Inverted index from n-grams to positions in a list of companies, or of names with key=None"""
+
+    # with n equal to the minimum lcs of the matching, no candidate that could pass the lcs check is lost
+    def __init__(self, companies, n=4, key="dev.search_string"):
+        self.n = n
+        self.postings = defaultdict(list)
+        for position, company in enumerate(companies):
+            for gram in ngrams(company[key] if key else company, n):
+                self.postings[gram].append(position)
+
+        company_count = len(companies) or 1
+        self.idf = {gram: math.log(company_count / len(positions)) + 1.0 for gram, positions in self.postings.items()}
+
+    def candidates(self, name, min_overlap=0.0, limit=None):
+        """Positions of the companies sharing an n-gram with name, best first, sharing at least min_overlap of its IDF weight"""
+        query_grams = [gram for gram in ngrams(name, self.n) if gram in self.postings]
+        total_weight = sum(self.idf[gram] for gram in query_grams)
+        if not total_weight:
+            return []
+
+        scores = defaultdict(float)
+        for gram in query_grams:
+            weight = self.idf[gram]
+            for position in self.postings[gram]:
+                scores[position] += weight
+
+        ranked = sorted(scores.items(), key=lambda x: (-x[1], x[0]))
+        candidates = [position for position, score in ranked if score / total_weight >= min_overlap]
+        return candidates[:limit] if limit else candidates
+
+
 def get_stop_words(words):
     different_words = set(words)
     stopword_count = int(15 * len(words) / len(different_words))  # heuristic
@@ -211,14 +512,7 @@ def get_stop_words(words):
     return static_stopwords | dynamic_stopwords | abbreviations
 
 
-def create_company_list_from_vinmonpolet(products):
-    companies_temp = {}
-    for product in products:
-        produsent = product["Produsent"]
-        if not produsent in companies_temp:
-            companies_temp[produsent] = []
-        companies_temp[produsent].append(product)
-
+def create_company_list_from_producers(companies_temp):
     companies = []
     company_id_counter = 0
     for name, products in companies_temp.items():
@@ -234,66 +528,260 @@ def create_company_list_from_vinmonpolet(products):
     return companies
 
 
-def import_products_from_vinmonopolet(filename):
+misspellings = {
+    "Les Grands Chais de France": "Les Grand Chais de France",
+    "Rocca di Frasinello": "Rocca di Frassinello",
+    "Pian delle Querce": "Pian delle Querci",
+    "Mercy, Dom. du Ch. Val de": "Dom. du Ch. du Val de Mercy",
+    "Cellier des Tiercelines": "Le Cellier des Tiercelines",
+    "Cave des Hautes-Côtes": "La Cave des Hautes-Côtes",
+    "Dom. Matrot, Thierry et Pascal": "Thierry et Pascale Matrot"
+}
+
+
+class Product:
+    """A Vinmonopolet product with only the columns in use, indexed like the csv rows"""
+    __slots__ = ("Varenummer", "Varenavn", "Volum", "Pris", "Literpris", "Varetype", "Produktutvalg",
+                 "Land", "Distrikt", "Underdistrikt", "Rastoff", "Alkohol", "Produsent", "Vareurl",
+                 "Emballasjetype", "Okologisk", "Fairtrade", "Miljosmart_emballasje")
+
+    # columns with few different values, kept as interned strings
+    repeated_columns = {"Volum", "Varetype", "Produktutvalg", "Land", "Distrikt", "Underdistrikt", "Produsent",
+                        "Emballasjetype", "Okologisk", "Fairtrade", "Miljosmart_emballasje"}
+
+    @classmethod
+    def from_row(cls, row, column_positions):
+        product = cls.__new__(cls)
+        for column, position in column_positions:
+            value = row[position]
+            setattr(product, column, sys.intern(value) if column in cls.repeated_columns else value)
+        return product
+
+    @classmethod
+    def column_positions(cls, header):
+        return [(column, header.index(column)) for column in cls.__slots__]
+
+    def __getitem__(self, key):
+        if key == "Lagerstatus":
+            return self.Produktutvalg  # mangler i exporten?
+        elif key == "ProduktBilde":
+            return "https://bilder.vinmonopolet.no/cache/600x600-0/%s-1.jpg" % self.Varenummer
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        try:
+            setattr(self, key, value)
+        except AttributeError:
+            raise KeyError(key)
+
+    def __getstate__(self):
+        return tuple(getattr(self, x) for x in self.__slots__)
+
+    def __setstate__(self, state):
+        for column, value in zip(self.__slots__, state):
+            setattr(self, column, value)
+
+    def to_dict(self):
+        values = {column: getattr(self, column) for column in self.__slots__}
+        values["Lagerstatus"] = self["Lagerstatus"]
+        values["ProduktBilde"] = self["ProduktBilde"]
+        return values
+
+
+def to_json(value):
+    # for json.dump's default argument, handles the types the pipeline adds to the Barnivore data
+    if isinstance(value, Product):
+        return value.to_dict()
+    elif isinstance(value, set):
+        return list(value)
+    raise TypeError("Object of type {} is not JSON serializable".format(type(value).__name__))
+
+
+def keep_vinmonopolet_product(product):
+    if product["Varetype"] == "Tilbehør":
+        # not a beverage
+        return False
+
+    if product["Produktutvalg"] == "Partiutvalget" or product["Produktutvalg"] == "Testutvalget":
+        # print("Skipping product that's not expected to stay in stores a while"))
+        return False
+
+    if not product["Land"]:
+        print("Error: Skipping entry due to missing country for product {}, id {}".format(product["Varenavn"],
+                                                                                          product["Varenummer"]))
+        return False
+
+    return True
+
+
+def is_wine(varetype):
+    return "vin" in varetype or "Champagne" in varetype
+
+
+def is_beer(varetype):
+    varetype = varetype.lower()
+    return any(x in varetype for x in ["ale", "lager", "kloster", "øl", "porter", "stout", "bitter", "barley"])
+
+
+def is_spirits(varetype):
+    return any(x in varetype for x in ["Akevitt", "Gin", "Madeira", "Rom", "Sake", "Sherry", "Vermut", "Likør",
+                                       "Genever", "Vodka", "Whisky"])
+
+
+product_categories = {"wine": is_wine, "beer": is_beer, "spirits": is_spirits}
+
+
+@lru_cache(maxsize=None)
+def classify_varetype(varetype):
+    """The categories a Varetype belongs to. There are only a few hundred different ones, so each is tested once"""
+    return tuple(category for category, test in product_categories.items() if test(varetype))
+
+
+def load_companies_from_vinmonopolet(filename, categories=tuple(product_categories)):
+    """Reads the Vinmonopolet export in one streaming pass, returns {category: companies} with Product records"""
+    producers_by_category = {category: {} for category in categories}
     with open(filename, 'r', newline='', encoding='iso-8859-1') as csvfile:
-        cvs_reader = csv.DictReader(csvfile, delimiter=';')
+        cvs_reader = csv.reader(csvfile, delimiter=';')
         try:
-            return list(cvs_reader)  # read it all into memory
+            column_positions = Product.column_positions(next(cvs_reader))
+            varetype_position = dict(column_positions)["Varetype"]
+            for row in cvs_reader:
+                product_categories_found = [x for x in classify_varetype(row[varetype_position]) if x in producers_by_category]
+                if not product_categories_found:
+                    continue
+                product = Product.from_row(row, column_positions)
+                if not keep_vinmonopolet_product(product):
+                    continue
+                if product.Produsent in misspellings:
+                    product.Produsent = misspellings[product.Produsent]
+                for category in product_categories_found:
+                    producers = producers_by_category[category]
+                    produsent = product["Produsent"]
+                    if not produsent in producers:
+                        producers[produsent] = []
+                    producers[produsent].append(product)
         except csv.Error as e:
             sys.exit('file {}, line {}: {}'.format(filename, cvs_reader.line_num, e))
 
+    return {category: create_company_list_from_producers(producers) for category, producers in producers_by_category.items()}
 
-def post_process_vinmonopolet_data(export_data):
-    products = []
-    for row in export_data:
-        # Headers are:
-        # Datotid;Varenummer;Varenavn;Volum;Pris;Literpris;Varetype;Produktutvalg;Butikkategori;
-        # Fylde;Friskhet; Garvestoffer; Bitterhet; Sodme; Farge; Lukt; Smak; Passertil01; Passertil02; Passertil03;
-        # Land; Distrikt; Underdistrikt;
-        # Argang; Rastoff; Metode; Alkohol; Sukker; Syre; Lagringsgrad;
-        # Produsent; Grossist; Distributor;
-        # Emballasjetype; Korktype; Vareurl;
-        # Okologisk; Biodynamisk; Fairtrade; Miljosmart_emballasje; Gluten_lav_pa; Kosher; HovedGTIN; AndreGTINs
 
-        product = row
-        product["Lagerstatus"] = row["Produktutvalg"]  # mangler i exporten?
-        product["ProduktBilde"] = "https://bilder.vinmonopolet.no/cache/600x600-0/%s-1.jpg" % (row["Varenummer"])
+# The product columns used by generatehtml.py, the only ones kept in the JSON Lines result files
+result_product_columns = ["Varenummer", "Varenavn", "Volum", "Pris", "Literpris", "Varetype", "Produktutvalg", "Land", "Distrikt",
+                          "Underdistrikt", "Rastoff", "Alkohol", "Produsent", "Vareurl", "Emballasjetype", "Okologisk", "Fairtrade",
+                          "Miljosmart_emballasje"]
 
-        misspellings = {
-            "Les Grands Chais de France": "Les Grand Chais de France",
-            "Rocca di Frasinello": "Rocca di Frassinello",
-            "Pian delle Querce": "Pian delle Querci",
-            "Mercy, Dom. du Ch. Val de": "Dom. du Ch. du Val de Mercy",
-            "Cellier des Tiercelines": "Le Cellier des Tiercelines",
-            "Cave des Hautes-Côtes": "La Cave des Hautes-Côtes",
-            "Dom. Matrot, Thierry et Pascal": "Thierry et Pascale Matrot"
-        }
 
-        if product["Varetype"] is "Tilbehør":
-            # not a beverage
-            continue
+class ResultLinesWriter:
+    """Writes matched companies as JSON Lines, each product once, referred to by Varenummer"""
 
-        if product["Produktutvalg"] == "Partiutvalget" or product["Produktutvalg"] == "Testutvalget":
-            # print("Skipping product that's not expected to stay in stores a while"))
-            continue
+    def __init__(self, file):
+        self.file = file
+        self.written_products = set()
+        self.company_count = 0
+        self.write_line({"product_columns": result_product_columns})
 
-        if not product["Land"]:
-            print("Error: Skipping entry due to missing country for product {}, id {}".format(product["Varenavn"],
-                                                                                              product["Varenummer"]))
-            continue
+    def write_line(self, value):
+        self.file.write(json.dumps(value, ensure_ascii=False, separators=(',', ':'), default=to_json))
+        self.file.write("\n")
 
-        if product["Produsent"] in misspellings:
-            product["Produsent"] = misspellings[product["Produsent"]]
+    def write(self, company):
+        references = []
+        for product in company["products_found_at_vinmonopolet"]:
+            if product["Varenummer"] not in self.written_products:
+                self.written_products.add(product["Varenummer"])
+                self.write_line({"product": [product[column] for column in result_product_columns]})
+            references.append(product["Varenummer"])
+        values = dict(company)
+        values["products_found_at_vinmonopolet"] = references
+        self.write_line({"company": values})
+        self.company_count += 1
 
-        products.append(product)
 
-    return products
+def load_result_lines(file):
+    """Reads the companies in a file written by ResultLinesWriter, with their products in place of the references"""
+    columns = None
+    products = {}
+    companies = []
+    for line in file:
+        record = json.loads(line)
+        if "product" in record:
+            product = dict(zip(columns, record["product"]))
+            products[product["Varenummer"]] = product
+        elif "product_columns" in record:
+            columns = record["product_columns"]
+        else:
+            company = record["company"]
+            company["products_found_at_vinmonopolet"] = [products[x] for x in company["products_found_at_vinmonopolet"]]
+            companies.append(company)
+    return companies
 
 
-def load_companies_from_barnivore(filename):
-    companies = list()
-    with open(filename, encoding='utf-8') as file:
-        for candidate in json.loads(file.read()):
+non_whitespace = re.compile(r"[^ \t\r\n]")
+number_characters = re.compile(r"[0-9.eE+-]*")
+
+
+def iter_json_array(file, chunk_size=64 * 1024):
+    """Yields the elements of the JSON array in file one at a time, reading chunk_size characters at a time"""
+    decoder = json.JSONDecoder()
+    buffer = ""
+    position = 0
+
+    def next_non_whitespace():
+        nonlocal buffer, position
+        while True:
+            match = non_whitespace.search(buffer, position)
+            if match:
+                position = match.start()
+                return buffer[position]
+            buffer, position = file.read(chunk_size), 0
+            if not buffer:
+                return None
+
+    if next_non_whitespace() != "[":
+        raise ValueError("Expected a JSON array")
+    position += 1
+    if next_non_whitespace() == "]":
+        return
+
+    while True:
+        while True:
+            try:
+                element, end = decoder.raw_decode(buffer, position)
+                error = None
+            except ValueError as e:
+                # the element continues in the next chunk, or the file is broken
+                error = e
+            # a number followed by nothing but number characters may continue in the next chunk
+            if not error and not (isinstance(element, (int, float)) and number_characters.fullmatch(buffer, end)):
+                break
+            chunk = file.read(chunk_size)
+            if not chunk:
+                if error:
+                    raise error
+                break
+            buffer, position = buffer[position:] + chunk, 0
+        position = end
+        yield element
+
+        separator = next_non_whitespace()
+        if separator == "]":
+            return
+        elif separator != ",":
+            raise ValueError("Expected ',' or ']' after element in JSON array, got {}".format(repr(separator)))
+        position += 1
+        next_non_whitespace()
+        if position > chunk_size:
+            buffer, position = buffer[position:], 0
+
+
+def iter_companies_from_barnivore(filename, encoding_errors='ignore'):
+    """Yields the valid companies in a Barnivore dump one at a time, dropping invalid utf-8 unless encoding_errors says otherwise"""
+    with open(filename, encoding='utf-8', errors=encoding_errors) as file:
+        for candidate in iter_json_array(file):
             company = candidate["company"]
             if "country" not in company.keys() or not company["country"]:
                 print("Error: Skipping entry due to missing country for company {}, id {}".format(company["company_name"], company["id"]))
@@ -305,80 +793,45 @@ def load_companies_from_barnivore(filename):
             company['dev.countries'] = {translate_country_name(company['country'].lower(), company['id'])}
             company["barnivore_url"] = "http://www.barnivore.com/wine/{}/company".format(company["id"])
 
-            companies.append(company)
+            yield company
 
-    return companies
 
+def load_companies_from_barnivore(filename):
+    return list(iter_companies_from_barnivore(filename))
 
-def load_wine_companies_from_vinmonopolet(filename):
-    products = load_vinmonopolet_data(filename)
-    wine_products = [x for x in products if "vin" in x["Varetype"] or "Champagne" in x["Varetype"]]
 
-    return create_company_list_from_vinmonpolet(wine_products)
+def load_wine_companies_from_vinmonopolet(filename):
+    return load_companies_from_vinmonopolet(filename, ["wine"])["wine"]
 
 
 def load_beer_companies_from_vinmonopolet(filename):
-    products = load_vinmonopolet_data(filename)
-    beer_products = [x for x in products if "ale" in x["Varetype"].lower()
-                     or "lager" in x["Varetype"].lower()
-                     or "kloster" in x["Varetype"].lower()
-                     or "øl" in x["Varetype"].lower()
-                     or "porter" in x["Varetype"].lower()
-                     or "stout" in x["Varetype"].lower()
-                     or "bitter" in x["Varetype"].lower()
-                     or "barley" in x["Varetype"].lower()
-                     ]
-
-    return create_company_list_from_vinmonpolet(beer_products)
+    return load_companies_from_vinmonopolet(filename, ["beer"])["beer"]
 
 
 def load_spirits_companies_from_vinmonopolet(filename):
-    products = load_vinmonopolet_data(filename)
-
-    spirits_products = [x for x in products if
-                        "Akevitt" in x["Varetype"]
-                        or "Gin" in x["Varetype"]
-                        or "Madeira" in x["Varetype"]
-                        or "Rom" in x["Varetype"]
-                        or "Sake" in x["Varetype"]
-                        or "Sherry" in x["Varetype"]
-                        or "Vermut" in x["Varetype"]
-                        or "Likør" in x["Varetype"]
-                        or "Genever" in x["Varetype"]
-                        or "Vodka" in x["Varetype"]
-                        or "Whisky" in x["Varetype"]
-                        ]
+    return load_companies_from_vinmonopolet(filename, ["spirits"])["spirits"]
 
-    return create_company_list_from_vinmonpolet(spirits_products)
 
-
-def load_vinmonopolet_data(filename):
-    products = import_products_from_vinmonopolet(filename)
-    products = post_process_vinmonopolet_data(products)
-    return products
-
-
-def get_normalized_company_names(source_list):
+def get_normalized_company_names(source_list, normalizer=default_normalizer):
     words = []
     for source in source_list:
         for product in source:
-            normalized_company_name = normalize_name(product["company_name"])
-            words += normalized_company_name.split(" ")
+            words += normalizer.tokens(product["company_name"])
     return words
 
 
-def create_stopword_list(companies_from_barnivore, companies_at_vinmonopolet):
-    company_names = get_normalized_company_names([companies_from_barnivore, companies_at_vinmonopolet])
+def create_stopword_list(companies_from_barnivore, companies_at_vinmonopolet, normalizer=default_normalizer):
+    company_names = get_normalized_company_names([companies_from_barnivore, companies_at_vinmonopolet], normalizer)
     return get_stop_words(company_names)
 
 
-def add_normalized_names(company_list, stopwords):
+def add_normalized_names(company_list, stopwords, normalizer=default_normalizer):
     for company in company_list:
         company_name = company["company_name"]
-        company["dev.normalized_name"] = normalize_name(replace_abbreviations(company_name))
+        company["dev.normalized_name"] = normalizer.abbreviated(company_name)
 
-        normalized_name = normalize_name(company_name)
-        search_string_parts = [x for x in normalized_name.split(" ") if not x in stopwords]
+        normalized_name = normalizer.normalize(company_name)
+        search_string_parts = [x for x in normalizer.tokens(company_name) if not x in stopwords]
         search_string = " ".join(search_string_parts)
 
         if not search_string or len(search_string) < 4:
@@ -388,3 +841,90 @@ def add_normalized_names(company_list, stopwords):
         company["dev.search_string"] = search_string
 
     return company_list
+
+
+snapshot_format_version = 1
+
+
+def file_digest(filename):
+    digest = hashlib.sha256()
+    with open(filename, mode='rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def snapshot_key(*filenames):
+    # the normalization code is part of the key, so editing this module invalidates the snapshots
+    digest = hashlib.sha256(str(snapshot_format_version).encode('ascii'))
+    for filename in list(filenames) + [__file__]:
+        digest.update(file_digest(filename).encode('ascii'))
+    return digest.hexdigest()[:16]
+
+
+barnivore_filenames = {"wine": "wine.json", "beer": "beer.json", "spirits": "liquor.json"}
+
+
+def prepare_category_dataset(companies_at_vinmonopolet, barnivore_filename):
+    companies_from_barnivore = load_companies_from_barnivore(barnivore_filename)
+
+    stopwords = create_stopword_list(companies_from_barnivore, companies_at_vinmonopolet)
+    companies_at_vinmonopolet = add_normalized_names(companies_at_vinmonopolet, stopwords)
+    companies_from_barnivore = add_normalized_names(companies_from_barnivore, stopwords)
+    return companies_at_vinmonopolet, companies_from_barnivore, stopwords
+
+
+def snapshot_filename(snapshot_dir, vinmonopolet_filename, barnivore_filename, category):
+    prefix = "{}-{}-".format(category, os.path.splitext(os.path.basename(barnivore_filename))[0])
+    return prefix, os.path.join(snapshot_dir, prefix + snapshot_key(vinmonopolet_filename, barnivore_filename) + ".pickle")
+
+
+def read_snapshot(filename):
+    try:
+        with open(filename, mode='rb') as f:
+            version, datasets = pickle.load(f)
+        if version == snapshot_format_version:
+            return datasets
+    except (OSError, pickle.UnpicklingError, EOFError, ValueError):
+        pass
+    return None
+
+
+def write_snapshot(snapshot_dir, prefix, filename, datasets):
+    os.makedirs(snapshot_dir, exist_ok=True)
+    for other_filename in os.listdir(snapshot_dir):
+        if other_filename.startswith(prefix) and other_filename.endswith(".pickle"):
+            os.remove(os.path.join(snapshot_dir, other_filename))  # outdated snapshot
+    temp_filename = filename + ".tmp"
+    with open(temp_filename, mode='wb') as f:
+        pickle.dump((snapshot_format_version, datasets), f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(temp_filename, filename)
+
+
+def load_prepared_datasets(vinmonopolet_filename, barnivore_filename, category="wine", snapshot_dir=".snapshots"):
+    """The datasets of prepare_category_dataset for category, kept as a snapshot in snapshot_dir named after the input files and this module"""
+    return load_prepared_category_datasets(vinmonopolet_filename, {category: barnivore_filename}, snapshot_dir)[category]
+
+
+def load_prepared_category_datasets(vinmonopolet_filename, barnivore_filenames_by_category, snapshot_dir=".snapshots"):
+    """Like load_prepared_datasets for several categories, returns {category: datasets}, parsing the Vinmonopolet export once"""
+    datasets_by_category = {}
+    snapshots = {}
+    for category, barnivore_filename in barnivore_filenames_by_category.items():
+        if snapshot_dir:
+            snapshots[category] = snapshot_filename(snapshot_dir, vinmonopolet_filename, barnivore_filename, category)
+            datasets = read_snapshot(snapshots[category][1])
+            if datasets:
+                datasets_by_category[category] = datasets
+
+    missing_categories = [x for x in barnivore_filenames_by_category if x not in datasets_by_category]
+    if missing_categories:
+        companies_by_category = load_companies_from_vinmonopolet(vinmonopolet_filename, missing_categories)
+        for category in missing_categories:
+            datasets = prepare_category_dataset(companies_by_category[category], barnivore_filenames_by_category[category])
+            if snapshot_dir:
+                prefix, filename = snapshots[category]
+                write_snapshot(snapshot_dir, prefix, filename, datasets)
+            datasets_by_category[category] = datasets
+
+    return {category: datasets_by_category[category] for category in barnivore_filenames_by_category}